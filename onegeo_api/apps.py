@@ -15,6 +15,12 @@
 
 
 from django.apps import AppConfig
+from django.conf import settings
+from django.db import DatabaseError
+
+
+# Load the routing table of the search services when the application starts.
+WARM_UP = getattr(settings, 'ONEGEO_WARM_UP', False)
 
 
 class OnegeoAPIConfig(AppConfig):
@@ -22,3 +28,9 @@ class OnegeoAPIConfig(AppConfig):
 
     def ready(self):
         import onegeo_api.signals
+        if WARM_UP:
+            from onegeo_api.cache import routing_table
+            try:
+                routing_table.warm()
+            except DatabaseError:
+                pass  # i.e. the database is not migrated yet
@@ -0,0 +1,270 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from collections import namedtuple
+from collections import OrderedDict
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache import caches
+from hashlib import md5
+import json
+from onegeo_api.elastic import elastic_conn
+from onegeo_api.extensions import DEFAULT_QUERY_DSL
+from threading import Lock
+import time
+
+
+# Plugins are kept per process, for the last version of the search models
+# and index profiles. The version is shared through the Django cache, which
+# has to be shared by the processes (i.e. not the default local memory one)
+# for the changes to be seen by all of them before the timeout.
+PLUGIN_CACHE_SIZE = getattr(settings, 'ONEGEO_PLUGIN_CACHE_SIZE', 128)
+PLUGIN_CACHE_TIMEOUT = getattr(settings, 'ONEGEO_PLUGIN_CACHE_TIMEOUT', 300)
+
+# The routing table is loaded again when the version changes, or at the
+# latest after `ROUTING_TABLE_TIMEOUT` seconds.
+ROUTING_TABLE_TIMEOUT = getattr(settings, 'ONEGEO_ROUTING_TABLE_TIMEOUT', 60)
+
+# Search results are kept per process (unless the size is 0) and/or in a
+# Django cache (one of `CACHES`) shared by the processes.
+# Results bigger than `RESULT_CACHE_MAX_BYTES` are not cached. The indices
+# the aliases point to are looked up again after
+# `RESULT_CACHE_ALIAS_TIMEOUT` seconds. The cache is disabled by default.
+RESULT_CACHE_SIZE = getattr(settings, 'ONEGEO_RESULT_CACHE_SIZE', 0)
+RESULT_CACHE_TIMEOUT = getattr(settings, 'ONEGEO_RESULT_CACHE_TIMEOUT', 60)
+RESULT_CACHE_MAX_BYTES = getattr(
+    settings, 'ONEGEO_RESULT_CACHE_MAX_BYTES', 1048576)
+RESULT_CACHE_BACKEND = getattr(settings, 'ONEGEO_RESULT_CACHE_BACKEND', None)
+RESULT_CACHE_ALIAS_TIMEOUT = getattr(
+    settings, 'ONEGEO_RESULT_CACHE_ALIAS_TIMEOUT', 5)
+
+
+VERSION_KEY = 'onegeo_api:{}:version'
+
+
+def get_version(namespace):
+    """Return the version stamp of the namespace."""
+    key = VERSION_KEY.format(namespace)
+    version = cache.get(key)
+    if version is None:
+        # A version evicted from the cache starts again from a new value
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    """Invalidate what is cached for the namespace."""
+    key = VERSION_KEY.format(namespace)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), timeout=None)
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache whose entries expire after `timeout` seconds."""
+
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.timeout
+        expires = timeout and time.monotonic() + timeout or None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+plugin_cache = LRUCache(maxsize=PLUGIN_CACHE_SIZE, timeout=PLUGIN_CACHE_TIMEOUT)
+
+
+def get_plugin(key, factory):
+    """Return the plugin cached for the key, or create it with `factory`."""
+    key = (get_version('search'), key)
+    plugin = plugin_cache.get(key)
+    if plugin is None:
+        plugin = factory()
+        plugin_cache.set(key, plugin)
+    return plugin
+
+
+Route = namedtuple(
+    'Route', ('search_model', 'query_dsl', 'index_profiles', 'indices'))
+
+
+class RoutingTable(object):
+    """Search models and index profiles by service name.
+
+    The table is loaded at once, and loaded again when the version of the
+    search models and index profiles changes or when it expires (the
+    version is only seen by the other processes through a shared cache).
+    `_all` is the route to the indices of all the search models.
+    """
+
+    def __init__(self, timeout=ROUTING_TABLE_TIMEOUT):
+        self.timeout = timeout
+        self._version = None
+        self._expires = None
+        self._routes = {}
+        self._uuids = []
+        self._lock = Lock()
+
+    def _load(self):
+        SearchModel = apps.get_model(
+            app_label='onegeo_api', model_name='SearchModel')
+        queryset = SearchModel.objects.select_related(
+            'alias').prefetch_related('indexes__alias')
+
+        routes = {}
+        uuids = []
+        all_profiles = OrderedDict()
+        for search_model in queryset:
+            index_profiles = list(search_model.indexes.all())
+            route = Route(
+                search_model, search_model.query_dsl, index_profiles,
+                [m.uuid for m in index_profiles])
+            uuids.append((search_model.uuid, route))
+            if search_model.alias.alias_name:
+                routes[search_model.alias.alias_name] = route
+            all_profiles.update((m.pk, m) for m in index_profiles)
+
+        all_profiles = list(all_profiles.values())
+        routes['_all'] = Route(
+            None, DEFAULT_QUERY_DSL, all_profiles,
+            [m.uuid for m in all_profiles])
+        return routes, uuids
+
+    def _is_stale(self, version):
+        return version != self._version or (
+            self._expires is not None and self._expires < time.monotonic())
+
+    def warm(self):
+        version = get_version('search')
+        if self._is_stale(version):
+            with self._lock:
+                if self._is_stale(version):
+                    self._routes, self._uuids = self._load()
+                    self._version = version
+                    self._expires = self.timeout and \
+                        time.monotonic() + self.timeout or None
+
+    def get(self, name):
+        """Return the route of the service, if any.
+
+        As `SearchModel.get_or_raise()`, the name is either the alias name
+        of the search model or the beginning of its uuid.
+        """
+        self.warm()
+        routes, uuids = self._routes, self._uuids
+        found = [routes[name]] if name in routes else []
+        found += [route for uuid, route in uuids
+                  if uuid.startswith(name)
+                  and all(route is not r for r in found)]
+        if len(found) == 1:
+            return found[0]
+
+
+routing_table = RoutingTable()
+
+
+class ResultCache(object):
+    """Serialized search results.
+
+    Results are keyed by the search (service, parameters and body) and by
+    the indices the aliases point to, so that the cache is invalidated
+    once an alias is switched to a new index. The keys do not depend on
+    the process, so they are shared through the backend. Otherwise, a
+    result is kept until it expires (e.g. when an index is updated in
+    place).
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE,
+                 timeout=RESULT_CACHE_TIMEOUT,
+                 max_bytes=RESULT_CACHE_MAX_BYTES,
+                 backend=RESULT_CACHE_BACKEND,
+                 alias_timeout=RESULT_CACHE_ALIAS_TIMEOUT):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.local = LRUCache(maxsize=maxsize, timeout=timeout)
+        self.backend = backend and caches[backend] or None
+        self.enabled = maxsize > 0 or self.backend is not None
+        self._indices = LRUCache(
+            maxsize=max(maxsize, 128), timeout=alias_timeout)
+
+    def resolve(self, aliases):
+        """Return the indices of the aliases (looked up again once they
+        expire)."""
+        resolved = []
+        for alias in aliases:
+            indices = self._indices.get(alias)
+            if indices is None:
+                indices = sorted(elastic_conn.get_indices_by_alias(alias))
+                self._indices.set(alias, indices)
+            resolved.append(indices)
+        return resolved
+
+    def get_key(self, name, params, body, aliases, **kwargs):
+        data = json.dumps([
+            name, sorted(params.items()), body, self.resolve(aliases),
+            sorted(kwargs.items())], sort_keys=True, default=str)
+        return 'onegeo_api:result:{}'.format(
+            md5(data.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Return the content type and the content of the result."""
+        result = self.local.get(key)
+        if result is None and self.backend:
+            result = self.backend.get(key)
+            if result is not None:
+                self.local.set(key, result)
+        return result
+
+    def set(self, key, content_type, content):
+        if len(content) > self.max_bytes:
+            return
+        self.local.set(key, (content_type, content))
+        if self.backend:
+            self.backend.set(
+                key, (content_type, content), timeout=self.timeout)
+
+
+result_cache = ResultCache()
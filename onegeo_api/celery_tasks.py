@@ -24,12 +24,15 @@ from celery.signals import task_rejected
 from celery.signals import task_revoked
 from celery.signals import task_success
 from celery.signals import task_unknown
+from celery.signals import worker_process_init
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
 from django.apps import apps
 from django.contrib.auth.models import User
 from django.utils import timezone
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.exceptions import ElasticError
+from onegeo_api.fingerprints import get_fingerprint_store
 from onegeo_api.models.analysis import get_complete_analysis
 from uuid import UUID
 
@@ -72,6 +75,12 @@ def on_beforehand(headers=None, body=None, sender=None, **kwargs):
         task_name=sender, user=user, resource_ns=resource_ns)
 
 
+@worker_process_init.connect
+def on_worker_process_init(**kwargs):
+    """Do not share the connections to Elasticsearch with the parent."""
+    elastic_conn.reset()
+
+
 # @task_prerun.connect
 # def on_task_prerun(**kwargs):
 #     pass
@@ -168,7 +177,7 @@ def indexing(alias=None, index_profile=None, index=None,
     analyzers = []
     for col in iter(index_profile.columns):
 
-        name = col.pop('name')
+        name = col.get('name')
         alias = col.get('alias')
         rejected = col.get('rejected')
         if not rejected:
@@ -199,31 +208,84 @@ def indexing(alias=None, index_profile=None, index=None,
         index_profile.onegeo.update_property(name, 'search_analyzer', search_analyzer)
 
     mappings = index_profile.onegeo.generate_elastic_mapping()
+    optimized = index_profile.optimize_mapping(mappings['foo'])
 
     body = {
         'mappings': {
             index: mappings.get('foo')},
-        'settings': {
-            'codec': 'best_compression',
-            'number_of_replicas': 0,
-            'analysis': get_complete_analysis(analyzer=analyzers, user=user)}}
+        'settings': dict(
+            index_profile.get_index_settings(),
+            analysis=get_complete_analysis(analyzer=analyzers, user=user))}
+
+    meta = mappings['foo'].setdefault('_meta', {})
+    meta['columns_mapping'] = columns_mapping
+    # Documents are routed by the value of a column
+    routing = index_profile.routing_column
+    if routing:
+        mappings['foo']['_routing'] = {'required': True}
+        meta['routing_column'] = next(
+            raw for raw, name in columns_mapping.items() if name == routing)
+    meta['digest'], meta['columns_digest'] = \
+        elastic_conn.get_body_digests(body, columns_mapping)
+
+    fingerprints = get_fingerprint_store(index_profile.uuid)
+
+    def on_progress(**status):
+        indexing.update_state(state='PROGRESS', meta=status)
+        Task.logged.filter(uuid=UUID(indexing.request.id)).update(
+            details={'index': index, 'progress': status})
+
+    # Unless data must be updated, changes which do not need to rewrite
+    # the documents (i.e. column renaming or adding) are applied to the
+    # live index.
+    if not force_update:
+        try:
+            updated = elastic_conn.update_in_place(
+                index_profile.uuid, body, columns_mapping,
+                fingerprints=fingerprints, progress=on_progress)
+        except ElasticError as e:
+            logger.warning('Unable to update the index in place: %s', e)
+        else:
+            if updated is not None:
+                res = {}
+                renamed, added = updated
+                if renamed:
+                    res['renamed'] = renamed
+                if added:
+                    res['added'] = added
+                return res
+
+    collection = index_profile.onegeo.get_collection()
+    # Unless it is set by the profile, the number of shards is estimated
+    # once the index has to be rebuilt.
+    if 'number_of_shards' not in body['settings']:
+        number_of_shards, collection = elastic_conn.estimate_number_of_shards(
+            index_profile.uuid, collection)
+        if number_of_shards:
+            body['settings']['number_of_shards'] = number_of_shards
 
     if index_profile.onegeo.resource.source.protocol == 'pdf':
         pipeline = elastic_conn.create_pipeline()
     else:
         pipeline = False
 
-    created, reindexed, failed = elastic_conn.create_or_reindex(
+    try:
+        previous_size = elastic_conn.get_store_size(index_profile.uuid)
+    except ElasticError:
+        previous_size = None
+
+    report = elastic_conn.create_or_reindex(
         index=index, body=body, alias=index_profile.uuid,
-        collection=index_profile.onegeo.get_collection(),
+        collection=collection,
         columns_mapping=columns_mapping, update=force_update,
-        pipeline=pipeline)
-
-    res = {}
-    if created:
-        res['created'] = len(created)  # {'count': len(created), 'ids': created}
-    if reindexed:
-        res['reindexed'] = len(reindexed)  # {'count': len(reindexed), 'ids': reindexed}
-    if failed:
-        res['failed'] = {'count': len(failed), 'details': failed}
+        pipeline=pipeline, fingerprints=fingerprints, progress=on_progress,
+        routing=routing)
+
+    res = report.as_dict()
+    res['store_size'] = {
+        'previous': previous_size,
+        'current': elastic_conn.get_store_size(index)}
+    optimized = dict((k, v) for k, v in optimized.items() if v)
+    if optimized:
+        res['optimized'] = optimized
     return res
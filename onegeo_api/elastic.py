@@ -14,25 +14,147 @@
 # under the License.
 
 
+from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from django.conf import settings
+from django.dispatch import Signal
 # from django.http import Http404
 from elasticsearch import Elasticsearch
 from elasticsearch import exceptions
 # from elasticsearch import helpers
 from functools import wraps
-import gc
-import itertools
+from hashlib import md5
+from itertools import chain
+import json
+import logging
+import math
+import os
 from onegeo_api.exceptions import ElasticError
-from onegeo_api.utils import estimate_size
+from onegeo_api.manifest import Manifest
+from onegeo_api.report import IndexingReport
+from onegeo_api.transport import get_connection_options
+from onegeo_api.transport import MAXSIZE
 from onegeo_api.utils import Singleton
-import operator
-# import json
+from queue import Full
+from queue import Queue
+from threading import Event
+from threading import Lock
+import time
 # from io import StringIO
 
 
+logger = logging.getLogger(__name__)
+
+
 HOSTS = settings.ELASTICSEARCH_HOSTS
 
 
+# Sent once the documents of the indices behind an alias have changed
+# (i.e. to invalidate the cached search results).
+index_changed = Signal(providing_args=['alias', 'index'])
+
+# Bulk requests are flushed when one of these limits is reached. These are
+# the initial values, which are then adapted from the measured latency and
+# rejection rate within the given ranges.
+BULK_MAX_DOCS = getattr(settings, 'ELASTICSEARCH_BULK_MAX_DOCS', 100)
+BULK_MAX_BYTES = getattr(settings, 'ELASTICSEARCH_BULK_MAX_BYTES', 10485760)
+BULK_DOCS_RANGE = getattr(
+    settings, 'ELASTICSEARCH_BULK_DOCS_RANGE', (10, 5000))
+BULK_BYTES_RANGE = getattr(
+    settings, 'ELASTICSEARCH_BULK_BYTES_RANGE', (1048576, 52428800))
+BULK_TARGET_LATENCY = getattr(
+    settings, 'ELASTICSEARCH_BULK_TARGET_LATENCY', 2.0)
+# Rejected items (HTTP 429) are retried with an exponential backoff.
+BULK_MAX_RETRIES = getattr(settings, 'ELASTICSEARCH_BULK_MAX_RETRIES', 3)
+BULK_INITIAL_BACKOFF = getattr(
+    settings, 'ELASTICSEARCH_BULK_INITIAL_BACKOFF', 2)
+BULK_MAX_BACKOFF = getattr(settings, 'ELASTICSEARCH_BULK_MAX_BACKOFF', 600)
+
+# Once filled, a new index is force-merged to this number of segments
+# (disabled when None) before being made available.
+FORCE_MERGE_SEGMENTS = getattr(
+    settings, 'ELASTICSEARCH_FORCE_MERGE_SEGMENTS', 1)
+FORCE_MERGE_TIMEOUT = getattr(
+    settings, 'ELASTICSEARCH_FORCE_MERGE_TIMEOUT', 3600)
+# Health status to wait for before switching the alias to a new index.
+WAIT_FOR_STATUS = getattr(settings, 'ELASTICSEARCH_WAIT_FOR_STATUS', 'green')
+WAIT_FOR_STATUS_TIMEOUT = getattr(
+    settings, 'ELASTICSEARCH_WAIT_FOR_STATUS_TIMEOUT', 600)
+
+# The number of primary shards of a new index keeps the shards under the
+# target size (in bytes). The size is the one of the previous index, or it
+# is estimated from a sample of the documents when the collection fits in.
+TARGET_SHARD_SIZE = getattr(
+    settings, 'ELASTICSEARCH_TARGET_SHARD_SIZE', 32212254720)
+SHARD_SIZING_SAMPLE_SIZE = getattr(
+    settings, 'ELASTICSEARCH_SHARD_SIZING_SAMPLE_SIZE', 10000)
+
+# Index settings which can be updated on a live index.
+DYNAMIC_SETTINGS = (
+    'number_of_replicas', 'refresh_interval', 'max_result_window',
+    'translog.durability', 'translog.sync_interval')
+
+# Documents are scanned with a sliced scroll. The slices are scrolled in
+# parallel (one slice per primary shard when None), by at most
+# `SCAN_MAX_SLICES` threads, which the connection pool is sized for.
+SCAN_SLICES = getattr(settings, 'ELASTICSEARCH_SCAN_SLICES', None)
+SCAN_MAX_SLICES = getattr(settings, 'ELASTICSEARCH_SCAN_MAX_SLICES', 8)
+SCAN_SIZE = getattr(settings, 'ELASTICSEARCH_SCAN_SIZE', 1000)
+SCAN_SCROLL = getattr(settings, 'ELASTICSEARCH_SCAN_SCROLL', '5m')
+
+# Documents are copied from an index to another with a sliced `_reindex`
+# run in background, whose progress is polled.
+REINDEX_SLICES = getattr(settings, 'ELASTICSEARCH_REINDEX_SLICES', 'auto')
+REINDEX_POLL_INTERVAL = getattr(
+    settings, 'ELASTICSEARCH_REINDEX_POLL_INTERVAL', 5)
+# When only some of the documents are copied, they are excluded or selected
+# by ids queries of at most this number of ids. Batches of ids are copied
+# with a synchronous `_reindex`, within the given timeout (in seconds).
+REINDEX_MAX_IDS = getattr(settings, 'ELASTICSEARCH_REINDEX_MAX_IDS', 65536)
+REINDEX_BATCH_TIMEOUT = getattr(
+    settings, 'ELASTICSEARCH_REINDEX_BATCH_TIMEOUT', 600)
+
+_END_OF_SLICE = object()
+
+
+# Stored script renaming, removing and adding the columns of a document
+# during a reindex, and routing it by the value of a column. The changes
+# are given as parameters, so the script is only compiled once. It also
+# drops the `_columns_mapping` field that was formerly stored in every
+# document (it now lives in the mapping `_meta`).
+# An added column which is already populated is kept as is.
+COLUMNS_MAPPING_SCRIPT_ID = 'onegeo-columns-mapping'
+COLUMNS_MAPPING_SCRIPT = (
+    'Map p = ctx._source.properties;'
+    'Map b = ctx._source._backup;'
+    'ctx._source.remove("_columns_mapping");'
+    'Map moved = new HashMap();'
+    'for (c in params.rename) {'
+    '  moved.put(c.get("target"), p.remove(c.get("source")));'
+    '}'
+    'for (c in params.remove) {'
+    '  p.remove(c.get("source"));'
+    '}'
+    'for (c in params.add) {'
+    '  def v = b == null ? null : b.remove(c.get("raw"));'
+    '  if (v != null || !p.containsKey(c.get("target"))) {'
+    '    moved.put(c.get("target"), v);'
+    '  }'
+    '}'
+    'p.putAll(moved);'
+    'if (params.routing != null) {'
+    '  def v = p.get(params.routing);'
+    '  ctx._routing = v == null ? ctx._id : v.toString();'
+    '}')
+# Documents bigger than this (once encoded) are rejected.
+DOCUMENT_MAX_BYTES = getattr(
+    settings, 'ELASTICSEARCH_DOCUMENT_MAX_BYTES', 104857600)
+# Number of bulk requests in flight while indexing a collection.
+BULK_CONCURRENCY = getattr(settings, 'ELASTICSEARCH_BULK_CONCURRENCY', 1)
+
+
 def elastic_exceptions_handler(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -52,58 +174,267 @@ def elastic_exceptions_handler(f):
     return wrapper
 
 
+class BulkSizer(object):
+    """Adapt the size of the bulk requests.
+
+    The limits grow while requests are faster than the target latency,
+    and shrink when requests are too slow or when the cluster rejects
+    items.
+    """
+
+    def __init__(self, max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES,
+                 docs_range=BULK_DOCS_RANGE, bytes_range=BULK_BYTES_RANGE,
+                 target_latency=BULK_TARGET_LATENCY):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.docs_range = docs_range
+        self.bytes_range = bytes_range
+        self.target_latency = target_latency
+        self._lock = Lock()
+
+    def record(self, duration, count, rejected=0):
+        if rejected:
+            factor = 0.5
+        elif duration > self.target_latency * 1.5:
+            factor = 0.8
+        elif duration < self.target_latency / 2:
+            factor = 1.25
+        else:
+            return
+        with self._lock:
+            self.max_docs = int(min(
+                max(self.max_docs * factor, self.docs_range[0]),
+                self.docs_range[1]))
+            self.max_bytes = int(min(
+                max(self.max_bytes * factor, self.bytes_range[0]),
+                self.bytes_range[1]))
+
+
+class BulkBuffer(object):
+    """Accumulate bulk actions as an NDJSON encoded payload.
+
+    Each action (header and document) is serialized only once, and the
+    buffer is flushed on the real encoded byte count.
+    """
+
+    def __init__(self, serializer, sizer=None):
+        self.serializer = serializer
+        self.sizer = sizer or BulkSizer()
+        self.actions = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.actions)
+
+    def encode(self, header, document):
+        return '{0}\n{1}\n'.format(
+            self.serializer.dumps(header),
+            self.serializer.dumps(document)).encode('utf-8')
+
+    def is_full(self, size=0):
+        return len(self.actions) > 0 and (
+            len(self.actions) >= self.sizer.max_docs or
+            self.size + size > self.sizer.max_bytes)
+
+    def append(self, _id, data):
+        self.actions.append((_id, data))
+        self.size += len(data)
+
+    def flush(self):
+        actions = self.actions
+        self.actions = []
+        self.size = 0
+        return actions
+
+
+class BulkSender(object):
+    """Send bulk requests with at most `concurrency` requests in flight.
+
+    With a concurrency of 1, requests are sent synchronously.
+    """
+
+    def __init__(self, send, concurrency=BULK_CONCURRENCY):
+        self.send = send
+        self.concurrency = concurrency
+        self.pending = set()
+        self.executor = None
+        if concurrency > 1:
+            self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.executor:
+            return
+        if exc_type:
+            for future in self.pending:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def submit(self, actions):
+        if not self.executor:
+            self.send(actions)
+            return
+        while len(self.pending) >= self.concurrency:
+            done, self.pending = wait(
+                self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()  # Raise the exception if any
+        self.pending.add(self.executor.submit(self.send, actions))
+
+    def join(self):
+        pending, self.pending = self.pending, set()
+        for future in as_completed(pending):
+            future.result()
+
+
 class ElasticWrapper(metaclass=Singleton):
 
+    """Elasticsearch client shared by the threads of a process.
+
+    The client is re-created in a forked process (i.e. Celery prefork
+    workers), so that connections are never shared across processes.
+    """
+
     def __init__(self):
-        self.conn = Elasticsearch(hosts=HOSTS)
+        self._conn = None
+        self._pid = None
+        self._lock = Lock()
+        self._scripts = set()
+
+    @property
+    def conn(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.reset()
+        return self._conn
+
+    def reset(self):
+        """Create a new client, dropping the connections of the previous one.
+
+        Connections inherited from the parent process are left as they are,
+        so that it can go on using them.
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.transport.close()
+        self._conn = Elasticsearch(
+            hosts=HOSTS, **get_connection_options(
+                maxsize=max(
+                    MAXSIZE, BULK_CONCURRENCY + SCAN_MAX_SLICES + 1)))
+        self._pid = os.getpid()
 
     def create_or_reindex(self, index=None, body=None, alias=None,
                           collection=None, columns_mapping=None,
-                          update=None, pipeline=False):
+                          update=None, pipeline=False,
+                          concurrency=BULK_CONCURRENCY, fingerprints=None,
+                          progress=None, routing=None):
+        """Create the index, fill it and switch the alias to it.
+
+        Documents are routed by the value of the `routing` column, if any.
+
+        `fingerprints` is an optional FingerprintStore. When it describes
+        the previous index, it replaces the scan of this index, and it is
+        updated with the documents of the new one.
 
+        `progress` is an optional callable receiving the status of the
+        copy of the documents from the previous index.
+
+        Return an IndexingReport.
+        """
         prev_indices = self.get_indices_by_alias(alias, unique=True)
         if len(prev_indices) > 1:
             raise Exception('TODO')
 
+        body, index_settings = self.get_build_body(body)
         self.create_index(index, body)
 
-        created = []
-        failed = []
-        reindexed = []
-
-        docs = {}
+        manifest = None
         if len(prev_indices) == 1:
             prev_index = prev_indices[0]
-            docs = self.list_documents(index=prev_index)
+            if fingerprints:
+                manifest = fingerprints.load(prev_index)
+            if manifest is None:
+                manifest = self.get_manifest(prev_index)
 
-        if docs:
-            actual = [
-                (dict(e[0]), list(m[0] for m in e[1]))
-                for e in itertools.groupby(
-                    docs[prev_index], key=operator.itemgetter(1))]
-            try:
-                reindexed, _failed, created = \
-                    self.reindex_collection(
-                        prev_index, index, collection, actual,
-                        columns_mapping, update=update, pipeline=pipeline)
-            except Exception as e:
-                self.delete_index(index)
-                raise e
-            else:
-                failed += _failed
-        else:
-            try:
-                created, _failed = self.index_collection(
-                    index, collection, columns_mapping, pipeline=pipeline)
-            except Exception as e:
-                self.delete_index(index)
-                raise e
+        # Every document of the new index has the current columns mapping
+        key = tuple(sorted(columns_mapping.items()))
+        writer = fingerprints and fingerprints.writer(index)
+        report = IndexingReport(
+            index, on_created=writer and (lambda _id: writer.add(key, _id)))
+
+        try:
+            if manifest:
+                reindexed, excluded = self.reindex_collection(
+                    prev_index, index, collection, manifest,
+                    columns_mapping, report, update=update,
+                    pipeline=pipeline, concurrency=concurrency,
+                    progress=progress, routing=routing)
+                if writer:
+                    for _, digests in reindexed.groups():
+                        for hexdigest in digests:
+                            if hexdigest not in excluded:
+                                writer.add(key, hexdigest)
             else:
-                failed += _failed
+                self.index_collection(
+                    index, collection, report, pipeline=pipeline,
+                    concurrency=concurrency, routing=routing)
+            self.finalize_index(index, index_settings)
+        except Exception as e:
+            writer and writer.discard()
+            self.delete_index(index)
+            raise e
+        finally:
+            report.close()
 
-        self.switch_aliases(index, alias)
+        try:
+            self.switch_aliases(index, alias)
+        except Exception as e:
+            writer and writer.discard()
+            raise e
+        writer and writer.commit()
+
+        return report
+
+    @staticmethod
+    def get_build_body(body):
+        """Return the body to create an index optimized for bulk loading.
+
+        Refresh and replicas are disabled while the index is filled. The
+        returned settings are the ones to restore once it is done.
+        """
+        body = dict(body or {})
+        build_settings = dict(body.get('settings', {}))
+        index_settings = {}
+        for key in ('refresh_interval', 'number_of_replicas'):
+            value = build_settings.pop(key, None)
+            value = build_settings.pop('index.{}'.format(key), value)
+            index_settings[key] = value  # None resets to the default
+        build_settings['refresh_interval'] = -1
+        build_settings['number_of_replicas'] = 0
+        body['settings'] = build_settings
+        return body, index_settings
 
-        return created, reindexed, failed
+    @elastic_exceptions_handler
+    def finalize_index(self, index, index_settings,
+                       max_num_segments=FORCE_MERGE_SEGMENTS):
+        """Force-merge the index, then restore its settings."""
+        if max_num_segments:
+            self.conn.indices.forcemerge(
+                index=index, max_num_segments=max_num_segments,
+                request_timeout=FORCE_MERGE_TIMEOUT)
+        self.conn.indices.put_settings(
+            index=index, body={'index': index_settings})
+        self.conn.indices.refresh(index=index)
+        res = self.conn.cluster.health(
+            index=index, wait_for_status=WAIT_FOR_STATUS,
+            timeout='{}s'.format(WAIT_FOR_STATUS_TIMEOUT),
+            request_timeout=WAIT_FOR_STATUS_TIMEOUT + 10)
+        if res.get('timed_out'):
+            logger.warning(
+                "Index '%s' is still %s after %d seconds.",
+                index, res.get('status'), WAIT_FOR_STATUS_TIMEOUT)
 
     @elastic_exceptions_handler
     def create_index(self, index, body):
@@ -111,140 +442,171 @@ class ElasticWrapper(metaclass=Singleton):
 
     @elastic_exceptions_handler
     def reindex_collection(self, prev_index, next_index, collection,
-                           actual, columns_mapping, step=1000,
-                           chunk_size=10485760, update=False, pipeline=False):
-
-        painless = []
-        REPLACE_COLUMN = (
-            'ctx._source.properties["{new}"]=ctx._source.properties.remove("{old}");'
-            'ctx._source._columns_mapping["{raw}"]="{new}"')
-        ADD_COLUMN = (
-            'ctx._source.properties["{new}"]=ctx._source._backup.remove("{raw}");'
-            'ctx._source._columns_mapping["{raw}"]="{new}"')
-        REMOVE_COLUMN = (
-            'ctx._source.properties.remove("{old}");'
-            'ctx._source._columns_mapping.remove("{raw}")')
-
-        prev_collection = []
-        for prev_columns_mapping, prev_docs in actual:
-
-            left = set()
-            right = set()
-            gc.collect(generation=2)
-
-            prev_collection += prev_docs
-            if prev_columns_mapping != columns_mapping:
-
-                left = set(prev_columns_mapping) - set(columns_mapping)
-                right = set(columns_mapping) - set(prev_columns_mapping)
-                intersect = set.intersection(
-                    set(prev_columns_mapping), set(columns_mapping))
-
-                if intersect:
-                    for raw in intersect:
-                        new = columns_mapping[raw]
-                        old = prev_columns_mapping.get(raw)
-                        if old and new != old:
-                            painless.append(
-                                REPLACE_COLUMN.format(
-                                    new=new, old=old, raw=raw))
-                if left:
-                    for raw in left:
-                        painless.append(
-                            REMOVE_COLUMN.format(
-                                old=prev_columns_mapping[raw], raw=raw))
-                if right:
-                    for raw in right:
-                        painless.append(
-                            ADD_COLUMN.format(
-                                new=columns_mapping[raw], raw=raw))
-
-        to_reindex = []
-        created = []
-        failed = []
-
+                           manifest, columns_mapping, report, step=1000,
+                           chunk_size=BULK_MAX_BYTES, update=False,
+                           pipeline=False, concurrency=BULK_CONCURRENCY,
+                           progress=None, routing=None,
+                           max_ids=REINDEX_MAX_IDS):
+        """Fill the new index from the previous one.
+
+        `manifest` lists the documents of the previous index grouped by
+        columns mapping. With `update`, the documents of the collection
+        which are not in the previous index are indexed and only the
+        unchanged documents are copied.
+
+        Documents are copied with a server-side `_reindex`: a single one
+        over the previous index when it is possible, otherwise one per
+        `max_ids` ids.
+
+        Return the manifest of the copied documents, and the ids of the
+        ones which failed.
+        """
         if update:
+            to_reindex = Manifest()
+
+            def new_documents():
+                for document in collection:
+                    key = manifest.get(document['_md5'])
+                    if key is None:
+                        yield document
+                    else:
+                        to_reindex.add(key, document['_md5'])
+
+            self.index_collection(
+                next_index, new_documents(), report, pipeline=pipeline,
+                step=step, chunk_size=chunk_size, concurrency=concurrency,
+                routing=routing)
+            to_reindex.freeze()
+        else:
+            to_reindex = manifest
+
+        # Documents of former indices carry their own columns mapping
+        prev_meta = self.get_meta(prev_index)
+        legacy = prev_meta.get('columns_mapping') is None
+
+        # Documents are routed again when the routing column changes
+        raws = dict((name, raw) for raw, name in columns_mapping.items())
+        rerouted = prev_meta.get('routing_column') != raws.get(routing)
+
+        failures = []
+        groups = dict(manifest.groups())
+        for key, digests in to_reindex.groups():
+            params = self.get_columns_mapping_params(
+                dict(key), columns_mapping)
+            params['routing'] = rerouted and routing or None
+            script = None
+            if legacy or rerouted or any(params.values()):
+                self.create_columns_mapping_script()
+                script = {'id': COLUMNS_MAPPING_SCRIPT_ID, 'params': params}
+
+            if len(groups) == 1:
+                removed = groups[key].difference(digests)
+                if len(removed) <= max_ids:
+                    query = None
+                    if removed:
+                        query = {'bool': {
+                            'must_not': {'ids': {'values': list(removed)}}}}
+                    failures += self.run_reindex(
+                        prev_index, next_index, query=query, script=script,
+                        progress=progress)
+                    continue
+
+            totals = {}
+
+            def on_batch(**status):
+                for k, v in status.items():
+                    totals[k] = totals.get(k, 0) + (v or 0)
+                callable(progress) and progress(**totals)
+
+            for ids in digests.chunks(max_ids):
+                failures += self.run_reindex(
+                    prev_index, next_index, query={'ids': {'values': ids}},
+                    script=script, progress=on_batch, background=False)
+
+        excluded = set()
+        for failure in failures:
+            excluded.add(failure.get('id'))
+            report.failed(failure.get('id'), failure.get('cause'))
+        report.reindexed(len(to_reindex) - len(excluded))
+
+        return to_reindex, excluded
 
-            body = []
-            body_size = 0
-            # count = 0
-            for document in collection:
-                # count += 1
-                # if count > 5000:
-                #     break
-
-                md5 = document.get('_md5')
-                if md5 in prev_collection:
-                    to_reindex.append(md5)
-                else:
-
-                    header = {'index': {'_id': md5, '_index': next_index, '_type': next_index}}
-                    document['_columns_mapping'] = columns_mapping
-                    doc = [header, document]
-
-                    try:
-                        doc_size = estimate_size(doc)
-                    except RecursionError:
-                        failed.append({md5: 'Unable to estimate size.'})
-                        continue
-                    if doc_size > 104857600:
-                        failed.append({md5: 'File size exceed max limit.'})
-                        continue
-
-                    x = len(body) / 2
-                    reload = x == step
-                    one_bullet_left = body_size + doc_size > chunk_size
-
-                    if one_bullet_left or reload:
-                        self._bulk(
-                            next_index, next_index, body, pipeline,
-                            created=lambda z: created.append(z),
-                            failed=lambda z: failed.append(z))
-                        body, body_size = doc, doc_size
-                        continue
-
-                    body += doc
-                    body_size += doc_size
-
-            if body:
-                self._bulk(
-                    next_index, next_index, body, pipeline,
-                    created=lambda z: created.append(z),
-                    failed=lambda z: failed.append(z))
+    @elastic_exceptions_handler
+    def run_reindex(self, prev_index, next_index, query=None, script=None,
+                    progress=None, background=True):
+        """Copy documents with a `_reindex`.
+
+        In background, the `_reindex` is sliced and polled until completion.
+        Otherwise, it is run at once (for batches of documents). Its status
+        is passed to the `progress` callable. Return the failures.
+        """
+        body = {
+            'source': {
+                'index': prev_index,
+                'type': prev_index,
+                'query': query or {'match_all': {}}},
+            'dest': {
+                'index': next_index,
+                'type': next_index,
+                'version_type': 'internal'}}
+        if script:
+            body['script'] = script
+
+        if not background:
+            res = self.conn.reindex(
+                body=body, wait_for_completion=True,
+                request_timeout=REINDEX_BATCH_TIMEOUT)
+            callable(progress) and progress(**dict(
+                (k, res.get(k)) for k in
+                ('total', 'created', 'updated', 'deleted', 'batches')))
+            return res.get('failures', [])
+
+        task_id = self.conn.reindex(
+            body=body, slices=REINDEX_SLICES,
+            wait_for_completion=False)['task']
+        return self.wait_for_task(task_id, progress=progress)
 
-        else:
-            to_reindex = prev_collection
-
-        count = len(to_reindex)
-        if count:
-            x = 0
-            for i in range(0, count - 1, step):
-                y = (count > i) and i < step and i or step + i
-                body = {
-                    'size': len(to_reindex[x:y]),
-                    'source': {
-                        'index': prev_index,
-                        'type': prev_index,
-                        'query': {
-                            'ids': {
-                                'type': prev_index,
-                                'values': to_reindex[x:y]}}},
-                    'dest': {
-                        'index': next_index,
-                        'type': next_index,
-                        'version_type': 'internal'}}
-
-                if painless:
-                    body['script'] = {
-                        'source': ';'.join(painless),
-                        'lang': 'painless'}
-
-                res = self.conn.reindex(body)
-                # TODO parse res
-                failed += res.get('failure', [])
-                x += step
-
-        return list(to_reindex), failed, created
+    @elastic_exceptions_handler
+    def wait_for_task(self, task_id, progress=None):
+        """Poll a background task until completion.
+
+        Its status is passed to the `progress` callable. Return the
+        failures.
+        """
+        interval = 0.5
+        while True:
+            time.sleep(interval)
+            interval = min(interval * 2, REINDEX_POLL_INTERVAL)
+            res = self.conn.tasks.get(task_id=task_id)
+            status = res['task']['status']
+            callable(progress) and progress(**dict(
+                (k, status.get(k)) for k in
+                ('total', 'created', 'updated', 'deleted', 'batches')))
+            if res.get('completed'):
+                break
+
+        if 'error' in res:
+            raise ElasticError(
+                'Task {0} failed: {1}.'.format(
+                    task_id, res['error'].get('reason')),
+                details={'error': res['error']})
+        return res.get('response', {}).get('failures', [])
+
+    @staticmethod
+    def get_columns_mapping_params(prev_columns_mapping, columns_mapping):
+        """Return the changes of columns for the columns mapping script."""
+        params = {'rename': [], 'remove': [], 'add': []}
+        for raw, target in columns_mapping.items():
+            source = prev_columns_mapping.get(raw)
+            if not source:
+                params['add'].append({'raw': raw, 'target': target})
+            elif source != target:
+                params['rename'].append(
+                    {'raw': raw, 'source': source, 'target': target})
+        for raw, source in prev_columns_mapping.items():
+            if raw not in columns_mapping:
+                params['remove'].append({'raw': raw, 'source': source})
+        return params
 
     # @elastic_exceptions_handler
     # def index_collection(self, index, collection, columns_mapping, pipeline=False):
@@ -271,76 +633,108 @@ class ElasticWrapper(metaclass=Singleton):
     #         max_retries=2, initial_backoff=2, stats_only=False,
     #         max_backoff=600, yield_ok=True)
 
-    def _bulk(self, index, doc_type, body, pipeline, created=None, failed=None):
-        try:
-            res = self.conn.bulk(
-                index=index, doc_type=doc_type, body=body,
-                pipeline=pipeline and 'attachment' or None)
-        except exceptions.SerializationError as e:
-            print(e)
-            return
-        except ValueError as e:
-            print(e)
-            return
-        for item in res.get('items'):
-            md5 = item['index']['_id']
-            error = item['index'].get('error')
-            if error:
-                callable(failed) and failed({md5: error})
+    def _bulk(self, index, doc_type, actions, pipeline,
+              created=None, failed=None, sizer=None):
+        """Send the (id, data) encoded actions in a bulk request.
+
+        Items rejected by the cluster are retried with an exponential
+        backoff, other item errors are reported as failed.
+        """
+        retries = 0
+        while actions:
+            rejected = []
+            start = time.monotonic()
+            try:
+                res = self.conn.bulk(
+                    index=index, doc_type=doc_type,
+                    body=b''.join(data for _, data in actions),
+                    pipeline=pipeline and 'attachment' or None)
+            except exceptions.TransportError as e:
+                if e.status_code != 429:
+                    raise e
+                rejected = [
+                    (_id, data, e.error) for _id, data in actions]
+            except (exceptions.SerializationError, ValueError) as e:
+                logger.error(
+                    'Bulk request of %d documents failed: %s',
+                    len(actions), e)
+                for _id, _ in actions:
+                    callable(failed) and failed(_id, str(e))
+                return
             else:
-                callable(created) and created(md5)
+                for (_id, data), item in zip(actions, res.get('items')):
+                    error = item['index'].get('error')
+                    if item['index'].get('status') == 429:
+                        rejected.append((_id, data, error))
+                    elif error:
+                        callable(failed) and failed(_id, error)
+                    else:
+                        callable(created) and created(_id)
+
+            if sizer:
+                sizer.record(
+                    time.monotonic() - start, len(actions), len(rejected))
+
+            if rejected and retries >= BULK_MAX_RETRIES:
+                for _id, _, error in rejected:
+                    callable(failed) and failed(_id, error)
+                return
+            if rejected:
+                backoff = min(
+                    BULK_INITIAL_BACKOFF * 2 ** retries, BULK_MAX_BACKOFF)
+                logger.warning(
+                    '%d documents rejected, retrying in %d seconds.',
+                    len(rejected), backoff)
+                time.sleep(backoff)
+                retries += 1
+            actions = [(_id, data) for _id, data, _ in rejected]
 
     @elastic_exceptions_handler
-    def index_collection(self, index, collection, columns_mapping,
-                         pipeline=False, step=100, chunk_size=10485760):
-        created = []
-        failed = []
-        body = []
-        body_size = 0
-        # count = 0
-
-        for document in collection:
-            # count += 1
-            # if count > 5000:
-            #     break
-
-            md5 = document.pop('_md5')
-            header = {'index': {'_id': md5, '_index': index, '_type': index}}
-            document['_columns_mapping'] = columns_mapping
-            doc = [header, document]
-
-            try:
-                doc_size = estimate_size(doc)
-            except RecursionError:
-                failed.append({md5: 'Unable to estimate size.'})
-                continue
-            if doc_size > 104857600:
-                failed.append({md5: 'File size exceed max limit.'})
-                continue
-
-            x = len(body) / 2
-            reload = x == step
-            one_bullet_left = body_size + doc_size > chunk_size
-
-            if one_bullet_left or reload:
-                self._bulk(
-                    index, index, body, pipeline,
-                    created=lambda z: created.append(z),
-                    failed=lambda z: failed.append(z))
-                body, body_size = doc, doc_size
-                continue
-
-            body += doc
-            body_size += doc_size
-
-        # else:
-        if body:
+    def index_collection(self, index, collection, report,
+                         pipeline=False, step=BULK_MAX_DOCS,
+                         chunk_size=BULK_MAX_BYTES,
+                         concurrency=BULK_CONCURRENCY, routing=None):
+        """Index the documents of the collection.
+
+        Documents are routed by the value of the `routing` column (or by
+        their id when it is empty). Created and failed documents are
+        counted by the IndexingReport.
+        """
+        sizer = BulkSizer(max_docs=step, max_bytes=chunk_size)
+        buffer = BulkBuffer(self.conn.transport.serializer, sizer=sizer)
+
+        def send(actions):
             self._bulk(
-                index, index, body, pipeline,
-                created=lambda z: created.append(z),
-                failed=lambda z: failed.append(z))
+                index, index, actions, pipeline,
+                created=report.created, failed=report.failed, sizer=sizer)
 
-        return created, failed
+        with BulkSender(send, concurrency=concurrency) as sender:
+            for document in collection:
+                md5 = document.pop('_md5')
+                header = {'index': {'_id': md5, '_index': index, '_type': index}}
+                if routing:
+                    value = document.get('properties', {}).get(routing)
+                    header['index']['routing'] = \
+                        value is None and md5 or str(value)
+
+                try:
+                    data = buffer.encode(header, document)
+                except exceptions.SerializationError as e:
+                    report.failed(
+                        md5, 'Unable to serialize document: {}'.format(e))
+                    continue
+                if len(data) > DOCUMENT_MAX_BYTES:
+                    report.failed(md5, 'File size exceed max limit.')
+                    continue
+
+                if buffer.is_full(len(data)):
+                    sender.submit(buffer.flush())
+                buffer.append(md5, data)
+
+            # else:
+            if buffer:
+                sender.submit(buffer.flush())
+            sender.join()
 
     @elastic_exceptions_handler
     def is_index_exists(self, **kwargs):
@@ -373,6 +767,7 @@ class ElasticWrapper(metaclass=Singleton):
             {'add': {'index': index, 'alias': name}})
 
         self.update_aliases(body)
+        index_changed.send(sender=self.__class__, alias=name, index=index)
         for i in range(len(indices)):
             self.delete_index(indices[i])
 
@@ -405,66 +800,343 @@ class ElasticWrapper(metaclass=Singleton):
         return self.conn.search(index=index, body=body, params=params)
 
     @elastic_exceptions_handler
-    def list_documents(self, index, step=1000, **kwargs):
-
-        x = 0
-        l = []
-        search_after = None
-        count = self.conn.count(index=index).get('count')
-        for i in range(0, count - 1, step):
-            y = (count > i) and i < step and i or step
-            body = {
-                '_source': '_columns_mapping',
-                'query': {'match_all': {}},
-                'size': y,
-                'sort': {'_id': 'asc'},
-                'stored_fields': []}
-
-            if x < 10000:
-                body['from'] = x
+    def msearch(self, searches):
+        """Run the (index, body, params) searches in a single request.
+
+        Return the responses in the same order, errors included.
+        """
+        body = []
+        for index, query, params in searches:
+            body.append(dict(params or {}, index=index))
+            body.append(query)
+        if not body:
+            return []
+        return self.conn.msearch(body=body)['responses']
+
+    @elastic_exceptions_handler
+    def get_number_of_shards(self, index):
+        res = self.conn.indices.get_settings(
+            index=index, name='index.number_of_shards', flat_settings=True)
+        return max(
+            int(v['settings']['index.number_of_shards'])
+            for v in res.values())
+
+    @elastic_exceptions_handler
+    def get_store_size(self, index):
+        """Return the size of the primary shards of the index (in bytes)."""
+        res = self.conn.indices.stats(index=index, metric='store')
+        return res['_all']['primaries']['store']['size_in_bytes']
+
+    def estimate_number_of_shards(self, alias, collection,
+                                  sample_size=SHARD_SIZING_SAMPLE_SIZE,
+                                  target_size=TARGET_SHARD_SIZE):
+        """Return the number of shards of the next index of the alias.
+
+        The size is the one of the current index, otherwise it is the size
+        of the encoded documents if there are less than `sample_size`. The
+        number of shards is None when the size is unknown.
+
+        As the collection may be consumed, it is returned as well.
+        """
+        size = None
+        if self.get_indices_by_alias(alias, unique=True):
+            try:
+                size = self.get_store_size(alias)
+            except ElasticError as e:
+                logger.warning("Unable to get the size of '%s': %s", alias, e)
+
+        if size is None:
+            sample = []
+            collection = iter(collection)
+            encoded = 0
+            dumps = self.conn.transport.serializer.dumps
+            for document in collection:
+                sample.append(document)
+                encoded += len(dumps(document).encode('utf-8'))
+                if len(sample) >= sample_size:
+                    break
             else:
-                body['search_after'] = [search_after]
+                size = encoded
+            collection = chain(sample, collection)
+
+        if size is None:
+            return None, collection
+        return max(1, math.ceil(size / target_size)), collection
+
+    def _scroll(self, index, body, scroll=SCAN_SCROLL):
+        res = self.conn.search(index=index, body=body, scroll=scroll)
+        scroll_id = res.get('_scroll_id')
+        try:
+            while res['hits']['hits']:
+                yield res['hits']['hits']
+                res = self.conn.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id')
+        finally:
+            if scroll_id:
+                self.conn.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+    @elastic_exceptions_handler
+    def scan(self, index, query=None, _source=False,
+             slices=SCAN_SLICES, size=SCAN_SIZE, scroll=SCAN_SCROLL):
+        """Yield all the hits matching the query.
+
+        The slices of a sliced scroll are consumed in parallel, so the
+        hits are yielded in no particular order.
+        """
+        body = {
+            '_source': _source,
+            'query': query or {'match_all': {}},
+            'size': size,
+            'sort': ['_doc']}
+
+        if slices is None:
+            slices = self.get_number_of_shards(index)
+        slices = min(slices, SCAN_MAX_SLICES)
+        if slices < 2:
+            for hits in self._scroll(index, body, scroll=scroll):
+                yield from hits
+            return
+
+        queue = Queue(maxsize=slices * 2)
+        stop = Event()
 
-            res = self.conn.search(index=index, body=body)
-            l += [(
-                hit['_index'],
-                hit['_id'],
-                tuple(sorted([(k, v) for k, v in hit['_source'].get('_columns_mapping', {}).items()]))
-                ) for hit in res['hits']['hits']]
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                except Full:
+                    continue
+                return True
+            return False
 
-            x += step
-            search_after = l[-1][1]
+        def scroll_slice(i):
+            try:
+                pages = self._scroll(
+                    index, dict(body, slice={'id': i, 'max': slices}),
+                    scroll=scroll)
+                for hits in pages:
+                    if not put(hits):
+                        pages.close()
+                        break
+            except Exception as e:
+                put(e)
+            finally:
+                put(_END_OF_SLICE)
 
-        groups = itertools.groupby(
-            sorted(l, key=operator.itemgetter(0)), key=operator.itemgetter(0))
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            for i in range(slices):
+                executor.submit(scroll_slice, i)
+            try:
+                running = slices
+                while running:
+                    item = queue.get()
+                    if item is _END_OF_SLICE:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield from item
+            finally:
+                stop.set()
 
-        return dict((g[0], [(m[1], m[2]) for m in tuple(g[1])]) for g in groups)
+    @elastic_exceptions_handler
+    def get_meta(self, index):
+        """Return the `_meta` of the mapping of the index."""
+        res = self.conn.indices.get_mapping(index=index)
+        for value in res.values():
+            for mapping in value['mappings'].values():
+                if '_meta' in mapping:
+                    return mapping['_meta']
+        return {}
+
+    def get_columns_mapping(self, index):
+        """Return the columns mapping stored in the `_meta` of the index.
+
+        Column names are the names of the properties in the documents,
+        which may differ from the current ones (see `get_field_aliases`).
+        """
+        return self.get_meta(index).get('columns_mapping')
+
+    def get_field_aliases(self, index):
+        """Return the current name of the renamed document properties."""
+        meta = self.get_meta(index)
+        columns_mapping = meta.get('columns_mapping', {})
+        return dict(
+            (columns_mapping[raw], name)
+            for raw, name in meta.get('aliases', {}).items()
+            if raw in columns_mapping)
 
     @elastic_exceptions_handler
-    def get_all_documents(self, index, step=1000, **kwargs):
-        _source = kwargs.pop('_source', [])
-
-        x = 0
-        search_after = None
-        count = self.conn.count(index=index).get('count')
-        for i in range(0, count - 1, step):
-            y = (count > i) and i < step and i or step
-            body = {
-                '_source': _source,
-                'query': {'match_all': {}},
-                'size': y,
-                'sort': {'_id': 'asc'},
-                'stored_fields': []}
-
-            if x < 10000:
-                body['from'] = x
-            else:
-                body['search_after'] = [search_after]
+    def get_version(self):
+        number = self.conn.info()['version']['number']
+        return tuple(int(v) for v in number.split('-')[0].split('.'))
+
+    @staticmethod
+    def get_body_digests(body, columns_mapping):
+        """Return the digests of the index body regardless of column names.
+
+        The first one is the digest of the body without the mapping of the
+        columns, the second one the digests of the mapping of each column.
+        """
+        def digest(data):
+            return md5(
+                json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+        raws = dict((name, raw) for raw, name in columns_mapping.items())
+        mappings = []
+        columns_digest = {}
+        for mapping in body.get('mappings', {}).values():
+            mapping = dict(mapping)
+            mapping.pop('_meta', None)
+            properties = dict(mapping.get('properties', {}))
+            columns = dict(properties.get('properties', {}))
+            for name, value in columns.pop('properties', {}).items():
+                columns_digest[raws.get(name, name)] = digest(value)
+            properties['properties'] = columns
+            mapping['properties'] = properties
+            mappings.append(mapping)
+
+        # Dynamic settings are updated in place
+        index_settings = dict(
+            (k, v) for k, v in body.get('settings', {}).items()
+            if k not in DYNAMIC_SETTINGS)
+
+        return digest({
+            'mappings': mappings,
+            'settings': index_settings}), columns_digest
 
-            res = self.conn.search(index=index, body=body)
-            yield from res['hits']['hits']
-            x += step
-            search_after = res['hits']['hits'][-1]['_id']
+    @elastic_exceptions_handler
+    def update_in_place(self, alias, body, columns_mapping,
+                        fingerprints=None, progress=None):
+        """Apply the changes of the index body without rebuilding it.
+
+        Renamed columns get field aliases pointing to the properties of
+        the documents, which are kept as they are. Added columns are put
+        in the mapping, then populated from the `_backup` of the
+        documents. Dynamic settings are updated. Any other change
+        requires to rebuild the index.
+
+        Return the numbers of renamed and added columns, or None when the
+        index has to be rebuilt.
+        """
+        indices = self.get_indices_by_alias(alias, unique=True)
+        if len(indices) != 1:
+            return None
+        index = indices[0]
+
+        meta = dict(next(iter(body['mappings'].values()))['_meta'])
+        prev_meta = self.get_meta(index)
+        if not prev_meta.get('digest') \
+                or prev_meta['digest'] != meta.get('digest'):
+            return None
+
+        if prev_meta.get('routing_column') != meta.get('routing_column'):
+            return None
+
+        physical = prev_meta['columns_mapping']
+        if not set(physical).issubset(columns_mapping):
+            return None  # Some columns are removed
+        prev_columns_digest = prev_meta.get('columns_digest', {})
+        for raw in physical:
+            if prev_columns_digest.get(raw) != meta['columns_digest'].get(raw):
+                return None  # The mapping of the column has changed
+
+        added = dict(
+            (raw, name) for raw, name in columns_mapping.items()
+            if raw not in physical)
+        prev_aliases = prev_meta.get('aliases', {})
+        aliases = dict(
+            (raw, name) for raw, name in columns_mapping.items()
+            if raw in physical and name != physical[raw])
+        renamed = sum(
+            1 for raw, name in aliases.items()
+            if name != prev_aliases.get(raw, physical[raw]))
+        if aliases and self.get_version() < (6, 4):
+            return None  # Field aliases are not supported
+
+        fields = dict(
+            (name, {'type': 'alias',
+                    'path': 'properties.{}'.format(physical[raw])})
+            for raw, name in aliases.items())
+        mapping = next(iter(body['mappings'].values()))
+        columns = mapping['properties']['properties']['properties']
+        for name in added.values():
+            fields[name] = columns[name]
+
+        physical = dict(physical, **added)
+        meta.update({'aliases': aliases, 'columns_mapping': physical})
+        self.conn.indices.put_settings(index=index, body={'index': dict(
+            (k, body['settings'].get(k)) for k in DYNAMIC_SETTINGS)})
+        self.conn.indices.put_mapping(
+            index=index, doc_type=index, body={
+                '_meta': meta,
+                'properties': {'properties': {'properties': fields}}})
+
+        if added:
+            try:
+                self.create_columns_mapping_script()
+                params = {
+                    'rename': [], 'remove': [], 'routing': None,
+                    'add': [{'raw': raw, 'target': name}
+                            for raw, name in added.items()]}
+                task_id = self.conn.update_by_query(
+                    index=index, doc_type=index,
+                    body={'script': {
+                        'id': COLUMNS_MAPPING_SCRIPT_ID, 'params': params}},
+                    slices=REINDEX_SLICES, wait_for_completion=False)['task']
+                failures = self.wait_for_task(task_id, progress=progress)
+                if failures:
+                    raise ElasticError(
+                        'Unable to populate the added columns of '
+                        'index {0}.'.format(index),
+                        details={'error': {'reason': str(failures[0])}})
+            except Exception:
+                # The documents are not (or only partially) populated: the
+                # previous columns mapping is restored so that the index is
+                # rebuilt with every added column.
+                self.conn.indices.put_mapping(
+                    index=index, doc_type=index, body={'_meta': prev_meta})
+                raise
+            if fingerprints:
+                fingerprints.replace_columns_mapping(
+                    index, tuple(sorted(physical.items())))
+
+        index_changed.send(sender=self.__class__, alias=alias, index=index)
+        return renamed, len(added)
+
+    @elastic_exceptions_handler
+    def get_manifest(self, index, **kwargs):
+        """Return the Manifest of the documents of the index."""
+        manifest = Manifest()
+
+        columns_mapping = self.get_columns_mapping(index)
+        if columns_mapping is not None:
+            key = tuple(sorted(columns_mapping.items()))
+            for hit in self.scan(index, _source=False, **kwargs):
+                manifest.add(key, hit['_id'])
+            return manifest.freeze()
+
+        # else: columns mapping is stored in each document
+        for hit in self.scan(index, _source=['_columns_mapping'], **kwargs):
+            columns_mapping = \
+                hit.get('_source', {}).get('_columns_mapping', {})
+            manifest.add(tuple(sorted(columns_mapping.items())), hit['_id'])
+        return manifest.freeze()
+
+    @elastic_exceptions_handler
+    def get_all_documents(self, index, **kwargs):
+        yield from self.scan(
+            index, _source=kwargs.pop('_source', []), **kwargs)
+
+    @elastic_exceptions_handler
+    def create_columns_mapping_script(self):
+        if COLUMNS_MAPPING_SCRIPT_ID in self._scripts:
+            return True
+        body = {'script': {
+            'lang': 'painless', 'source': COLUMNS_MAPPING_SCRIPT}}
+        self.conn.put_script(id=COLUMNS_MAPPING_SCRIPT_ID, body=body)
+        self._scripts.add(COLUMNS_MAPPING_SCRIPT_ID)
+        return True
 
     def create_pipeline(self, field='_raw'):
         body = {'description': 'Attachment',
@@ -16,12 +16,19 @@
 
 from abc import ABCMeta
 from abc import abstractmethod
+from django.conf import settings
 from django.http import JsonResponse
 import itertools
-from json import dumps
 from json import loads
+from onegeo_api.elastic import elastic_conn
 import operator
 import re
+import time
+
+
+# The routing column of the indices of an alias is looked up again after
+# `ROUTING_ALIAS_TIMEOUT` seconds.
+ROUTING_ALIAS_TIMEOUT = getattr(settings, 'ONEGEO_ROUTING_ALIAS_TIMEOUT', 10)
 
 
 DEFAULT_QUERY_DSL = {
@@ -44,7 +51,157 @@ DEFAULT_QUERY_DSL = {
     'size': '{%size|10%}'}
 
 
+def find_term_values(query, field):
+    """Return the values the query requires for the field, if any.
+
+    Only the `term` and `terms` queries which every hit has to match
+    (i.e. in the `must` or `filter` clauses of a `bool` query) count.
+    """
+    if not isinstance(query, dict):
+        return None
+    if isinstance(query.get('term'), dict) and field in query['term']:
+        value = query['term'][field]
+        if isinstance(value, dict):
+            value = value.get('value')
+        values = [value]
+    elif isinstance(query.get('terms'), dict) and field in query['terms']:
+        values = query['terms'][field]
+        if not isinstance(values, list):
+            return None
+    elif isinstance(query.get('constant_score'), dict):
+        return find_term_values(query['constant_score'].get('filter'), field)
+    elif isinstance(query.get('bool'), dict):
+        for occur in ('filter', 'must'):
+            clauses = query['bool'].get(occur, [])
+            for clause in isinstance(clauses, list) and clauses or [clauses]:
+                values = find_term_values(clause, field)
+                if values:
+                    return values
+        return None
+    else:
+        return None
+    if not values or any(v is None or v == '' for v in values):
+        return None
+    return set(str(v) for v in values)
+
+
+_routing_columns = {}
+
+
+def get_routing_column(alias, timeout=ROUTING_ALIAS_TIMEOUT):
+    """Return the current name of the column which the documents of all
+    the indices of the alias are routed by, if any.
+
+    It is read from the `_meta` of the indices, and kept for `timeout`
+    seconds.
+    """
+    expires, column = _routing_columns.get(alias, (None, None))
+    if expires is None or expires < time.monotonic():
+        columns = set()
+        for index in elastic_conn.get_indices_by_alias(alias) or [None]:
+            meta = index and elastic_conn.get_meta(index) or {}
+            raw = meta.get('routing_column')
+            columns.add(raw and (
+                meta.get('aliases', {}).get(raw)
+                or meta.get('columns_mapping', {}).get(raw)) or None)
+        column = len(columns) == 1 and columns.pop() or None
+        _routing_columns[alias] = (time.monotonic() + timeout, column)
+    return column
+
+
+class QueryTemplate(object):
+    """Query DSL template compiled once into a tree of slots.
+
+    `{%name|default%}` placeholders are slots filled with the parameters of
+    the search (an empty string when a parameter is missing and has no
+    default). `{*prefix.<type>*}` placeholders are resolved at compile time
+    with the fields returned by `get_fields(type, prefix)`: in a list, they
+    are expanded into one item per field. Both keys and values of the
+    query DSL may hold placeholders.
+    """
+
+    PARAM = re.compile('{%(.+?)%}')
+    FIELDS = re.compile('{\*(.+?)\*}')
+    FIELDS_PATTERN = re.compile('(\w+)\.\<(\w+)\>')
+    PARAM_SPEC = re.compile('^(\w+)(\|(.+))?$')
+    SEPARATOR = '\x00'
+
+    def __init__(self, query_dsl, get_fields):
+        self.get_fields = get_fields
+        self.params = []
+        self._render = self._compile(query_dsl)
+
+    def render(self, **params):
+        return self._render(params)
+
+    def _expand_fields(self, value, separator):
+        return self.FIELDS.sub(
+            lambda m: self.FIELDS_PATTERN.sub(
+                lambda m: separator.join(
+                    self.get_fields(m.group(2), prefix=m.group(1))),
+                m.group(1)),
+            value)
+
+    def _compile(self, value):
+        if isinstance(value, dict):
+            # Keys may be parameterized as well (e.g. the field of a sort)
+            items = [
+                (self._compile_string(self._expand_fields(k, ',')),
+                 self._compile(v)) for k, v in value.items()]
+            return lambda params: dict(
+                (k(params), f(params)) for k, f in items)
+        if isinstance(value, list):
+            items = []
+            for item in value:
+                if isinstance(item, str) and self.FIELDS.search(item):
+                    items.extend(
+                        self._compile(piece) for piece in self._expand_fields(
+                            item, self.SEPARATOR).split(self.SEPARATOR))
+                else:
+                    items.append(self._compile(item))
+            return lambda params: [f(params) for f in items]
+        if isinstance(value, str):
+            return self._compile_string(self._expand_fields(value, ','))
+        return lambda params: value
+
+    def _compile_string(self, value):
+        parts = self.PARAM.split(value)
+        if len(parts) == 1:
+            return lambda params: value
+
+        slots = []
+        for i, part in enumerate(parts):
+            if i % 2:
+                m = self.PARAM_SPEC.match(part)
+                name, default = m and (m.group(1), m.group(3)) or (part, None)
+                self.params.append((name, default))
+                slots.append((name, default))
+            else:
+                slots.append(part)
+
+        def get(params, name, default):
+            value = params.get(name, default)
+            return '' if value is None else value
+
+        if len(slots) == 3 and slots[0] == slots[2] == '':
+            name, default = slots[1]
+            return lambda params: get(params, name, default)
+        return lambda params: ''.join(
+            slot if isinstance(slot, str) else get(params, *slot)
+            for slot in slots)
+
+
 class AbstractPlugin(metaclass=ABCMeta):
+    """Search plugin of a service.
+
+    A plugin is created for each search, unless its class is `cacheable`:
+    it is then kept and shared by the searches (and the threads) of the
+    process. A cacheable plugin must be stateless, i.e. `input` and
+    `output` must not modify it (for instance `self.query_dsl`), and what
+    it caches must be thread-safe.
+    """
+
+    cacheable = False
 
     def __init__(self, query_dsl, index_profiles, **kwargs):
         self.query_dsl = query_dsl
@@ -56,11 +213,17 @@ class AbstractPlugin(metaclass=ABCMeta):
                 (p['alias'] and p['alias'] or p['name'], p['type'])
                 for p in index_profile.columns if not p['rejected'])
 
-        self.qs = []
-        for found in re.findall('(?<={%).+?(?=%})', dumps(self.query_dsl)):
-            kv = tuple(found.split('|'))
-            k, v = len(kv) == 2 and (kv[0], kv[1]) or (kv[0], None)
-            self.qs.append((k, None, None, v))
+        self.column_names = set(
+            c[0] for c in itertools.chain.from_iterable(
+                self.columns_by_index.values()))
+        self.columns_by_type = dict(
+            (c[0], tuple(e[0] for e in c[1]))
+            for c in self._get_columns_grouped(1))
+        self._field_aliases = {}
+
+        self.template = QueryTemplate(
+            self.query_dsl or {}, self.get_all_same_type_columns)
+        self.qs = [(k, None, None, v) for k, v in self.template.params]
 
     @abstractmethod
     def input(self, **params):
@@ -72,19 +235,117 @@ class AbstractPlugin(metaclass=ABCMeta):
         raise NotImplementedError(
             "This is an abstract method. You can't do anything with it.")
 
+    def format(self, data, **params):
+        """Return the result of the search as it is output (i.e. to be
+        gathered with others in a multi-search)."""
+        return loads(self.output(data, **params).content.decode('utf-8'))
+
+    def get_field_aliases(self, index, names=()):
+        """Return the current name of the renamed properties of the index.
+
+        Properties of the documents keep their name when a column is
+        renamed in place (see `ElasticWrapper.update_in_place`).
+        """
+        aliases, checked = self._field_aliases.get(index, (None, set()))
+        if aliases is None or not set(names).issubset(checked):
+            aliases = elastic_conn.get_field_aliases(index)
+            checked = checked.union(names, aliases)
+            self._field_aliases[index] = (aliases, checked)
+        return aliases
+
+    def rename_properties(self, hit):
+        """Rename the properties of the hit with the current column names."""
+        properties = hit.get('_source', {}).get('properties')
+        if not isinstance(properties, dict):
+            return
+        unknown = set(properties) - self.column_names
+        if not unknown:
+            return
+        aliases = self.get_field_aliases(hit['_index'], names=unknown)
+        hit['_source']['properties'] = dict(
+            (aliases.get(k, k), v) for k, v in properties.items())
+        if hit.get('highlight'):
+            hit['highlight'] = dict(
+                (re.sub(
+                    '^properties\.([^.]+)',
+                    lambda m: 'properties.{}'.format(
+                        aliases.get(m.group(1), m.group(1))), k), v)
+                for k, v in hit['highlight'].items())
+
+    def get_index_sort(self):
+        """Return the sort shared by the indices, if any."""
+        sorts = [p.get_index_sort() for p in self.index_profiles]
+        if sorts and all(sort == sorts[0] for sort in sorts):
+            return sorts[0]
+        return []
+
+    def is_index_sorted(self, query_dsl):
+        """Tell if the hits are sorted as the indices are.
+
+        In this case, the search can terminate early once the first hits
+        are collected.
+        """
+        sort = query_dsl.get('sort')
+        index_sort = self.get_index_sort()
+        if not sort or not index_sort:
+            return False
+        sort = isinstance(sort, list) and sort or [sort]
+        if len(sort) > len(index_sort):
+            return False
+        for item, (field, order) in zip(sort, index_sort):
+            if isinstance(item, str):
+                item = {item: 'asc'}
+            if not isinstance(item, dict) or len(item) != 1:
+                return False
+            name, value = next(iter(item.items()))
+            if isinstance(value, dict):
+                if set(value) - {'order'}:
+                    return False
+                value = value.get('order', 'asc')
+            if name != field or value != order:
+                return False
+        return True
+
+    def get_routing(self, query_dsl):
+        """Return the routing of the search, if the query constrains the
+        column which the documents of all the indices are routed by."""
+        columns = set(p.routing_column for p in self.index_profiles)
+        column = len(columns) == 1 and columns.pop() or None
+        if not column:
+            return None
+        values = find_term_values(
+            query_dsl.get('query'), 'properties.{}'.format(column))
+        if not values:
+            return None
+        # The profiles may have changed since their indices were built
+        if any(get_routing_column(p.uuid) != column
+               for p in self.index_profiles):
+            return None
+        return ','.join(sorted(values))
+
+    def get_search_params(self, query_dsl):
+        """Return the parameters of the search request."""
+        params = {}
+        routing = self.get_routing(query_dsl)
+        if routing:
+            params['routing'] = routing
+        return params
+
     def _get_columns_grouped(self, i):
         l = list(itertools.chain.from_iterable(self.columns_by_index.values()))
         return itertools.groupby(
             sorted(l, key=operator.itemgetter(1)), key=operator.itemgetter(i))
 
     def get_all_same_type_columns(self, type, prefix='properties'):
-        return dict(
-            (c[0], list('{}.{}'.format(prefix, e[0]) for e in tuple(c[1])))
-            for c in self._get_columns_grouped(1)).get(type, [])
+        return list(
+            '{}.{}'.format(prefix, name)
+            for name in self.columns_by_type.get(type, ()))
 
 
 class Plugin(AbstractPlugin):
 
+    cacheable = True
+
     def __init__(self, query_dsl, index_profiles, **kwargs):
         super().__init__(query_dsl, index_profiles, **kwargs)
 
@@ -92,34 +353,26 @@ class Plugin(AbstractPlugin):
 
         _id = params.get('_id')
         if _id:
-            self.query_dsl = {'query': {'ids': {'values': _id}}}
+            query_dsl = {'query': {'ids': {'values': _id}}}
         else:
-            query_dsl = re.sub(
-                '{%(.+?)%}',
-                lambda m: re.sub(
-                    '(\w+)(\|(.+))?',
-                    lambda m: params.get(m.group(1), m.group(3)),
-                    m.group(1)),
-                dumps(self.query_dsl))
-
-            query_dsl = re.sub(
-                '{\*(.+?)\*}',
-                lambda m: re.sub(
-                    '(\w+)\.\<(\w+)\>',
-                    lambda m: '", "'.join(
-                        self.get_all_same_type_columns(
-                            m.group(2), prefix=m.group(1))),
-                    m.group(1)),
-                query_dsl)
-            self.query_dsl = loads(query_dsl)
-
-        self.query_dsl['_source'] = {'excludes': ['_columns_mapping', '_backup']}
-        return self.query_dsl
+            query_dsl = self.template.render(**params)
+
+        query_dsl['_source'] = {'excludes': ['_columns_mapping', '_backup']}
+        if 'track_total_hits' not in query_dsl \
+                and 'aggs' not in query_dsl \
+                and 'aggregations' not in query_dsl \
+                and self.is_index_sorted(query_dsl):
+            query_dsl['track_total_hits'] = False
+        return query_dsl
 
     def output(self, data, **params):
+        return JsonResponse(self.format(data, **params))
+
+    def format(self, data, **params):
 
         results = []
         for hit in data['hits']['hits']:
+            self.rename_properties(hit)
             d1 = {'id': '_id' in hit and hit['_id'] or None,
                   'score': '_score' in hit and hit['_score'] or None,
                   'index': '_type' in hit and hit['_type'] or None}
@@ -131,13 +384,15 @@ class Plugin(AbstractPlugin):
 
             results.append({**d1, **d2})
 
+        # The total is unknown (-1) when the search terminates early
+        total = data['hits']['total']
         response = {'results': results,
-                    'total': data['hits']['total']}
+                    'total': total if total >= 0 else None}
 
         if 'aggregations' in data:
             response['aggregations'] = data['aggregations']
 
-        return JsonResponse(response)
+        return response
 
 
 plugin = Plugin
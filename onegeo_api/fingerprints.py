@@ -0,0 +1,169 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.conf import settings
+import json
+import logging
+from onegeo_api.manifest import Manifest
+from onegeo_api.manifest import to_digest
+import os
+import sqlite3
+from threading import Lock
+
+
+logger = logging.getLogger(__name__)
+
+
+# Directory of the fingerprint databases (disabled when None).
+FINGERPRINTS_ROOT_DIR = getattr(settings, 'FINGERPRINTS_ROOT_DIR', None)
+
+
+SCHEMA = (
+    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE mappings (id INTEGER PRIMARY KEY, columns_mapping TEXT)',
+    'CREATE TABLE fingerprints ('
+    'digest BLOB PRIMARY KEY, mapping INTEGER) WITHOUT ROWID')
+
+
+class FingerprintWriter(object):
+    """Record the fingerprints of the documents of a new index.
+
+    The database is written aside and only replaces the previous one
+    once committed.
+    """
+
+    def __init__(self, path, index, batch_size=10000):
+        self.path = path
+        self.index = index
+        self.batch_size = batch_size
+        self.tmp_path = '{0}.{1}.tmp'.format(path, index)
+        self._mappings = {}
+        self._batch = []
+        self._lock = Lock()
+
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.conn = sqlite3.connect(self.tmp_path, check_same_thread=False)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+    def _get_mapping_id(self, key):
+        if key not in self._mappings:
+            self._mappings[key] = len(self._mappings) + 1
+            self.conn.execute(
+                'INSERT INTO mappings VALUES (?, ?)',
+                (self._mappings[key], json.dumps(key)))
+        return self._mappings[key]
+
+    def add(self, key, hexdigest):
+        self.add_digest(key, to_digest(hexdigest))
+
+    def add_digest(self, key, digest):
+        with self._lock:
+            self._batch.append((digest, self._get_mapping_id(key)))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO fingerprints VALUES (?, ?)', self._batch)
+        self._batch = []
+
+    def commit(self):
+        with self._lock:
+            self._flush()
+            self.conn.execute(
+                "INSERT INTO meta VALUES ('index', ?)", (self.index,))
+            self.conn.commit()
+            self.conn.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        with self._lock:
+            self.conn.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class FingerprintStore(object):
+    """Fingerprints (md5 and columns mapping) of the indexed documents.
+
+    There is one SQLite database per IndexProfile, which describes the
+    index last built for it.
+    """
+
+    def __init__(self, name, root=FINGERPRINTS_ROOT_DIR):
+        self.path = os.path.join(root, '{}.sqlite3'.format(name))
+
+    def load(self, index):
+        """Return the Manifest recorded for the index, if any."""
+        if not os.path.exists(self.path):
+            return None
+        conn = sqlite3.connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'index'").fetchone()
+            if not row or row[0] != index:
+                return None
+            mappings = dict(
+                (i, tuple(tuple(item) for item in json.loads(value)))
+                for i, value in conn.execute('SELECT * FROM mappings'))
+            manifest = Manifest()
+            for digest, i in conn.execute('SELECT * FROM fingerprints'):
+                manifest.add_digest(mappings[i], digest)
+            return manifest.freeze()
+        except sqlite3.DatabaseError as e:
+            logger.warning("Unable to read '%s': %s", self.path, e)
+            return None
+        finally:
+            conn.close()
+
+    def replace_columns_mapping(self, index, key):
+        """Record that all the documents of the index now use `key`.
+
+        The database is deleted if it does not describe the index, or if
+        the documents do not share the same columns mapping.
+        """
+        if not os.path.exists(self.path):
+            return
+        conn = sqlite3.connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'index'").fetchone()
+            count = conn.execute('SELECT COUNT(*) FROM mappings').fetchone()
+            if row and row[0] == index and count[0] == 1:
+                conn.execute(
+                    'UPDATE mappings SET columns_mapping = ?',
+                    (json.dumps(key),))
+                conn.commit()
+                return
+        except sqlite3.DatabaseError as e:
+            logger.warning("Unable to update '%s': %s", self.path, e)
+        finally:
+            conn.close()
+        self.delete()
+
+    def writer(self, index):
+        return FingerprintWriter(self.path, index)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_fingerprint_store(name):
+    if FINGERPRINTS_ROOT_DIR:
+        return FingerprintStore(name)
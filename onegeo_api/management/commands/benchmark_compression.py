@@ -0,0 +1,91 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.core.management.base import BaseCommand
+from itertools import islice
+import json
+import math
+from onegeo_api.elastic import elastic_conn
+from onegeo_api.transport import compress
+import random
+import time
+
+
+def generate_features(count, vertices):
+    """Yield GeoJSON features similar to the ones of a vector layer."""
+    for i in range(count):
+        x, y = random.uniform(-5, 9), random.uniform(41, 51)
+        radius = random.uniform(0.001, 0.05)
+        ring = [
+            [round(x + radius * math.cos(2 * math.pi * j / vertices), 7),
+             round(y + radius * math.sin(2 * math.pi * j / vertices), 7)]
+            for j in range(vertices)]
+        ring.append(ring[0])
+        yield {
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+            'properties': {
+                'id': i,
+                'code': '{:05d}'.format(random.randint(0, 99999)),
+                'name': 'Feature {}'.format(i),
+                'area': round(random.uniform(0, 1e6), 2)}}
+
+
+class Command(BaseCommand):
+
+    help = 'Measure the CPU and bandwidth trade-off of compressing bulk requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--features', type=int, default=10000)
+        parser.add_argument('--vertices', type=int, default=200)
+        parser.add_argument(
+            '--index', help='Sample the documents of this index instead')
+        parser.add_argument(
+            '--levels', type=int, nargs='+', default=[1, 3, 6, 9])
+        parser.add_argument(
+            '--bandwidth', type=float, default=100,
+            help='Bandwidth to the cluster (Mbit/s)')
+
+    def handle(self, *args, **options):
+        if options['index']:
+            documents = (
+                hit['_source'] for hit in islice(elastic_conn.scan(
+                    options['index'], _source=True), options['features']))
+        else:
+            documents = generate_features(
+                options['features'], options['vertices'])
+
+        header = json.dumps({'index': {}})
+        body = ''.join(
+            '{0}\n{1}\n'.format(header, json.dumps(document))
+            for document in documents).encode('utf-8')
+
+        bandwidth = options['bandwidth'] * 1e6 / 8  # Bytes per second
+        transfer = len(body) / bandwidth
+        self.stdout.write(
+            'Raw: {0:.1f} MB, {1:.2f} s of transfer'.format(
+                len(body) / 1e6, transfer))
+
+        for level in options['levels']:
+            start = time.process_time()
+            size = len(compress(body, level=level))
+            cpu = time.process_time() - start
+            self.stdout.write(
+                'Level {0}: {1:.1f} MB (ratio {2:.2f}), {3:.2f} s of CPU '
+                '({4:.0f} MB/s), {5:.2f} s of transfer, {6:.2f} s saved'.format(
+                    level, size / 1e6, len(body) / size, cpu,
+                    len(body) / 1e6 / max(cpu, 1e-6), size / bandwidth,
+                    transfer - size / bandwidth - cpu))
@@ -0,0 +1,168 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from bisect import bisect_left
+import heapq
+
+
+DIGEST_SIZE = 16
+
+
+def to_digest(hexdigest):
+    try:
+        digest = bytes.fromhex(hexdigest)
+    except (TypeError, ValueError):
+        digest = None
+    if not digest or len(digest) != DIGEST_SIZE:
+        raise ValueError("'{}' is not a md5 hexdigest.".format(hexdigest))
+    return digest
+
+
+class DigestArray(object):
+    """Sorted array of packed md5 digests (16 bytes per document)."""
+
+    def __init__(self, data=b''):
+        self._data = bytes(data)
+
+    def __len__(self):
+        return len(self._data) // DIGEST_SIZE
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('Digest index out of range.')
+        return self._data[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+
+    def __contains__(self, hexdigest):
+        return self.has_digest(to_digest(hexdigest))
+
+    def __iter__(self):
+        for digest in self.iter_digests():
+            yield digest.hex()
+
+    def has_digest(self, digest):
+        i = bisect_left(self, digest)
+        return i < len(self) and self[i] == digest
+
+    def iter_digests(self):
+        view = memoryview(self._data)
+        for i in range(0, len(self._data), DIGEST_SIZE):
+            yield bytes(view[i:i + DIGEST_SIZE])
+
+    def chunks(self, size):
+        """Yield the hexdigests by lists of `size` items."""
+        chunk = []
+        for hexdigest in self:
+            chunk.append(hexdigest)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def difference(self, other):
+        """Return the digests which are not in `other`."""
+        data = bytearray()
+        right = other.iter_digests()
+        current = next(right, None)
+        for digest in self.iter_digests():
+            while current is not None and current < digest:
+                current = next(right, None)
+            if digest != current:
+                data += digest
+        return DigestArray(data)
+
+
+class DigestArrayBuilder(object):
+    """Build a DigestArray from unsorted hexdigests.
+
+    Digests are sorted by runs which are merged at the end, so that memory
+    stays close to 16 bytes per document.
+    """
+
+    def __init__(self, run_size=100000):
+        self.run_size = run_size
+        self._runs = []
+        self._current = []
+
+    def add(self, hexdigest):
+        self.add_digest(to_digest(hexdigest))
+
+    def add_digest(self, digest):
+        self._current.append(digest)
+        if len(self._current) >= self.run_size:
+            self._flush()
+
+    def _flush(self):
+        if self._current:
+            # A run is free of duplicates, as the merged array
+            digests = sorted(set(self._current))
+            self._runs.append(DigestArray(b''.join(digests)))
+            self._current = []
+
+    def build(self):
+        self._flush()
+        runs, self._runs = self._runs, []
+        if len(runs) == 1:
+            return runs[0]
+        data = bytearray()
+        previous = None
+        for digest in heapq.merge(*(run.iter_digests() for run in runs)):
+            if digest != previous:
+                data += digest
+                previous = digest
+        return DigestArray(data)
+
+
+class Manifest(object):
+    """Set of document md5 grouped by columns mapping.
+
+    Documents are added with `add()`, then `freeze()` must be called
+    before querying the manifest.
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._groups = {}
+
+    def __len__(self):
+        return sum(len(digests) for digests in self._groups.values())
+
+    def __contains__(self, hexdigest):
+        return self.get(hexdigest) is not None
+
+    def add(self, key, hexdigest):
+        self.add_digest(key, to_digest(hexdigest))
+
+    def add_digest(self, key, digest):
+        if key not in self._builders:
+            self._builders[key] = DigestArrayBuilder()
+        self._builders[key].add_digest(digest)
+
+    def freeze(self):
+        for key, builder in self._builders.items():
+            self._groups[key] = builder.build()
+        self._builders = {}
+        return self
+
+    def get(self, hexdigest):
+        """Return the key of the group containing the document."""
+        digest = to_digest(hexdigest)
+        for key, digests in self._groups.items():
+            if digests.has_digest(digest):
+                return key
+
+    def groups(self):
+        return self._groups.items()
@@ -0,0 +1,17 @@
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onegeo_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexprofile',
+            name='index_settings',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True, verbose_name='Index settings'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onegeo_api', '0002_indexprofile_index_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexprofile',
+            name='routing_column',
+            field=models.CharField(blank=True, max_length=250, null=True, verbose_name='Routing column'),
+        ),
+    ]
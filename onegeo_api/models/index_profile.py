@@ -16,19 +16,139 @@
 
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
+from django.conf import settings
 from django.db import models
 from django.urls import reverse
 from onegeo_api.elastic import elastic_conn
+from json import dumps
 from onegeo_api.models.abstracts import AbstractModelProfile
 import onegeo_manager
 import re
 
 
+# The mapping of the columns is reduced to what the search models use: the
+# columns which are not searchable are not indexed, the columns which are
+# not named in a search model have no doc values, and so on. As the index
+# has to be rebuilt once a search model refers to other columns, it is
+# disabled by default.
+OPTIMIZE_MAPPING = getattr(settings, 'ELASTICSEARCH_OPTIMIZE_MAPPING', False)
+
+
+# Settings of the index of a profile, unless they are set by the profile.
+DEFAULT_INDEX_SETTINGS = {
+    'codec': 'best_compression',
+    'number_of_replicas': 0}
+
+
+def is_integer(value, minimum=0, maximum=None):
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and value >= minimum and (maximum is None or value <= maximum)
+
+
+def is_time_value(value):
+    return value in (-1, '-1') or isinstance(value, str) \
+        and re.match('^\d+(ms|s|m|h|d)$', value) is not None
+
+
+def is_sort_values(value, choices=None):
+    if isinstance(value, str):
+        value = [value]
+    return isinstance(value, list) and len(value) > 0 and all(
+        isinstance(item, str) and (choices is None or item in choices)
+        for item in value)
+
+
+INDEX_SETTINGS_VALIDATORS = {
+    'codec': lambda v: v in ('default', 'best_compression'),
+    'number_of_shards': lambda v: is_integer(v, minimum=1, maximum=1024),
+    'number_of_replicas': lambda v: is_integer(v),
+    'refresh_interval': is_time_value,
+    'max_result_window': lambda v: is_integer(v, minimum=1),
+    'sort.field': is_sort_values,
+    'sort.order': lambda v: is_sort_values(v, choices=('asc', 'desc')),
+    'sort.missing': lambda v: is_sort_values(v, choices=('_first', '_last')),
+    'sort.mode': lambda v: is_sort_values(v, choices=('min', 'max')),
+    'translog.durability': lambda v: v in ('request', 'async'),
+    'translog.sync_interval': is_time_value}
+
+
+def flatten_index_settings(value):
+    """Return the settings with dotted keys (i.e. 'sort.field')."""
+    flat = {}
+    for key, val in value.items():
+        if key in ('sort', 'translog') and isinstance(val, dict):
+            for k, v in val.items():
+                flat['{0}.{1}'.format(key, k)] = v
+        else:
+            flat[key] = val
+    return flat
+
+
+# Types of the columns which may not be indexed (`index: false`).
+INDEXABLE_COLUMN_TYPES = (
+    'boolean', 'byte', 'date', 'double', 'float', 'half_float', 'integer',
+    'ip', 'keyword', 'long', 'scaled_float', 'short', 'text')
+
+# Types of the columns which have doc values (for sorting, aggregations and
+# scripts).
+DOC_VALUES_COLUMN_TYPES = (
+    'boolean', 'byte', 'date', 'double', 'float', 'geo_point', 'half_float',
+    'integer', 'ip', 'keyword', 'long', 'scaled_float', 'short')
+
+# Types of the columns which the index can be sorted on (doc values).
+SORTABLE_COLUMN_TYPES = (
+    'boolean', 'byte', 'date', 'double', 'float', 'half_float', 'integer',
+    'keyword', 'long', 'scaled_float', 'short')
+
+
+def validate_index_settings(value, columns=None):
+    """Validate the index settings of a profile.
+
+    The index sort is validated against the types of the `columns`.
+    """
+    if not isinstance(value, dict):
+        raise ValidationError("'index_settings' must be an object.")
+    flat = flatten_index_settings(value)
+    for key, val in flat.items():
+        if key not in INDEX_SETTINGS_VALIDATORS:
+            raise ValidationError(
+                "'{}' index setting is unauthorized.".format(key))
+        if not INDEX_SETTINGS_VALIDATORS[key](val):
+            raise ValidationError(
+                "'{0}' index setting is malformed: {1}.".format(key, val))
+
+    fields = flat.get('sort.field', [])
+    fields = isinstance(fields, str) and [fields] or fields
+    for key in ('sort.order', 'sort.missing', 'sort.mode'):
+        if key in flat and not fields:
+            raise ValidationError(
+                "'{}' index setting requires 'sort.field'.".format(key))
+        val = flat.get(key, fields)
+        if len(isinstance(val, str) and [val] or val) != len(fields):
+            raise ValidationError(
+                "'{}' index setting must have one value per sort field."
+                .format(key))
+
+    if fields and columns is not None:
+        types = dict(
+            (c.get('alias') or c.get('name'), c.get('type'))
+            for c in columns if not c.get('rejected'))
+        for field in fields:
+            if field not in types:
+                raise ValidationError(
+                    "Index sort field '{}' is not a column.".format(field))
+            if types[field] not in SORTABLE_COLUMN_TYPES:
+                raise ValidationError(
+                    "Index can not be sorted on '{0}' ('{1}' column)."
+                    .format(field, types[field]))
+
+
 class IndexProfile(AbstractModelProfile):
 
     class Extras(object):
         fields = (
             'columns', 'location', 'resource', 'reindex_frequency', 'title')
+        optional_fields = ('index_settings', 'routing_column')
 
     class Meta(object):
         verbose_name = 'Indexation Profile'
@@ -51,6 +171,12 @@ class IndexProfile(AbstractModelProfile):
     resource = models.ForeignKey(to='Resource', verbose_name='Resource',
                                  on_delete=models.CASCADE)
 
+    index_settings = JSONField(
+        verbose_name='Index settings', blank=True, null=True)
+
+    routing_column = models.CharField(
+        verbose_name='Routing column', blank=True, null=True, max_length=250)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._onegeo = None
@@ -103,12 +229,92 @@ class IndexProfile(AbstractModelProfile):
         return {
             'columns': self.columns,
             'location': self.location,
+            'index_settings': self.index_settings,
             'title': self.title,
             'reindex_frequency': self.reindex_frequency,
             'resource': self.resource.location,
+            'routing_column': self.routing_column,
             'synchronized': self.synchronized,
             'uuid': self.uuid}
 
+    def get_index_settings(self):
+        """Return the settings of the index (merged with the defaults)."""
+        index_settings = dict(DEFAULT_INDEX_SETTINGS)
+        index_settings.update(flatten_index_settings(self.index_settings or {}))
+        if 'sort.field' in index_settings:
+            # Columns are properties of the documents
+            fields = index_settings['sort.field']
+            index_settings['sort.field'] = [
+                'properties.{}'.format(field) for field in
+                (isinstance(fields, str) and [fields] or fields)]
+        return index_settings
+
+    def get_index_sort(self):
+        """Return the sort of the index as a list of (field, order)."""
+        index_settings = self.get_index_settings()
+        fields = index_settings.get('sort.field', [])
+        orders = index_settings.get('sort.order', ['asc'] * len(fields))
+        orders = isinstance(orders, str) and [orders] or orders
+        return list(zip(fields, orders))
+
+    def get_column_references(self):
+        """Return the columns which the search models refer to.
+
+        The first set holds the names of the columns, the second one the
+        types of the columns matched by a pattern (`None` for all of them).
+        """
+        names = set()
+        types = set()
+        for search_model in self.searchmodel_set.all():
+            # Highlighting does not need the columns to be indexed
+            query_dsl = dumps(dict(
+                (k, v) for k, v in (search_model.query_dsl or {}).items()
+                if k != 'highlight'))
+            for column in self.columns:
+                name = column.get('alias') or column.get('name')
+                if re.search(
+                        'properties\.{}(?!\w)'.format(re.escape(name)),
+                        query_dsl):
+                    names.add(name)
+            types.update(re.findall('properties\.\<(\w+)\>', query_dsl))
+            if re.search('properties\.\*', query_dsl):
+                types.add(None)
+        return names, types
+
+    def optimize_mapping(self, mapping):
+        """Reduce the mapping of the columns to the needs of the searches.
+
+        Return the names of the columns by disabled feature.
+        """
+        optimized = {'index': [], 'doc_values': [], 'norms': []}
+        if not OPTIMIZE_MAPPING:
+            return optimized
+
+        names, types = self.get_column_references()
+        sorted_names = set(
+            field.split('.', 1)[1] for field, _ in self.get_index_sort())
+        fields = mapping.get('properties', {}).get(
+            'properties', {}).get('properties', {})
+        for column in self.columns:
+            name = column.get('alias') or column.get('name')
+            if column.get('rejected') or name not in fields:
+                continue
+            field = fields[name]
+            column_type = field.get('type')
+            searchable = column.get('searchable') or name in names \
+                or None in types or column_type in types
+            if not searchable and column_type in INDEXABLE_COLUMN_TYPES:
+                field['index'] = False
+                optimized['index'].append(name)
+            if column_type in DOC_VALUES_COLUMN_TYPES \
+                    and name not in names and name not in sorted_names:
+                field['doc_values'] = False
+                optimized['doc_values'].append(name)
+            if column_type == 'text' and not searchable:
+                field['norms'] = False
+                optimized['norms'].append(name)
+        return optimized
+
     @classmethod
     def list_renderer(cls, user, **opts):
         return [item.detail_renderer(**opts)
@@ -125,4 +331,14 @@ class IndexProfile(AbstractModelProfile):
                 [prop.all() for prop in self.onegeo.iter_properties()]
         # else: # TODO Vérifier si le document est conforme
 
+        if self.index_settings is not None:
+            validate_index_settings(self.index_settings, columns=self.columns)
+
+        if self.routing_column and self.routing_column not in (
+                c.get('alias') or c.get('name')
+                for c in self.columns if not c.get('rejected')):
+            raise ValidationError(
+                "Routing column '{}' is not a column.".format(
+                    self.routing_column))
+
         return super().save(*args, **kwargs)
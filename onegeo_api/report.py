@@ -0,0 +1,110 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from collections import Counter
+from django.conf import settings
+import json
+import os
+import random
+from threading import Lock
+
+
+# Number of failures kept as a sample in the report of an indexing.
+FAILURES_SAMPLE_SIZE = getattr(settings, 'INDEXING_FAILURES_SAMPLE_SIZE', 100)
+# Directory where every failure is logged (disabled when None).
+FAILURES_LOG_DIR = getattr(settings, 'INDEXING_FAILURES_LOG_DIR', None)
+
+
+def get_error_type(error):
+    if isinstance(error, dict):
+        return error.get('type') or 'unknown'
+    return str(error).split(':', 1)[0]
+
+
+class IndexingReport(object):
+    """Counters of an indexing and a bounded sample of its failures.
+
+    The failures are sampled with a reservoir, so that the report has the
+    same size whatever the number of documents. They can also be logged
+    one per line in a file.
+
+    `on_created` is an optional callable receiving the id of every created
+    document.
+    """
+
+    def __init__(self, index, sample_size=FAILURES_SAMPLE_SIZE,
+                 log_dir=FAILURES_LOG_DIR, on_created=None):
+        self.sample_size = sample_size
+        self.on_created = on_created
+        self.created_count = 0
+        self.reindexed_count = 0
+        self.failed_count = 0
+        self.errors = Counter()
+        self.sample = []
+        self._lock = Lock()
+        self.log_path = None
+        self._log = None
+        if log_dir:
+            self.log_path = os.path.join(log_dir, '{}.jsonl'.format(index))
+            self._log = open(self.log_path, 'w')
+
+    def __bool__(self):
+        return bool(
+            self.created_count or self.reindexed_count or self.failed_count)
+
+    def created(self, _id):
+        with self._lock:
+            self.created_count += 1
+        callable(self.on_created) and self.on_created(_id)
+
+    def reindexed(self, count):
+        with self._lock:
+            self.reindexed_count += count
+
+    def failed(self, _id, error):
+        item = {'id': _id, 'error': error}
+        with self._lock:
+            self.failed_count += 1
+            self.errors[get_error_type(error)] += 1
+            if len(self.sample) < self.sample_size:
+                self.sample.append(item)
+            else:
+                i = random.randrange(self.failed_count)
+                if i < self.sample_size:
+                    self.sample[i] = item
+            if self._log:
+                self._log.write(json.dumps(item) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def as_dict(self):
+        res = {}
+        if self.created_count:
+            res['created'] = self.created_count
+        if self.reindexed_count:
+            res['reindexed'] = self.reindexed_count
+        if self.failed_count:
+            res['failed'] = {
+                'count': self.failed_count,
+                'errors': dict(self.errors),
+                'sample': self.sample}
+            if self.log_path:
+                res['failed']['log'] = self.log_path
+        return res
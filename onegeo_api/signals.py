@@ -14,11 +14,16 @@
 # under the License.
 
 
+from django.db.models.signals import m2m_changed
 from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from onegeo_api.cache import bump_version
 from onegeo_api.celery_tasks import data_source_analyzing
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.elastic import index_changed
+from onegeo_api.fingerprints import get_fingerprint_store
+from onegeo_api.models import Alias
 from onegeo_api.models import IndexProfile
 from onegeo_api.models import Resource
 from onegeo_api.models import SearchModel
@@ -43,6 +48,13 @@ def delete_elastic_related_index(sender, instance, **kwargs):
         elastic_conn.delete_index(index)
 
 
+@receiver(post_delete, sender=IndexProfile)
+def delete_related_fingerprints(sender, instance, **kwargs):
+    fingerprints = get_fingerprint_store(instance.uuid)
+    if fingerprints:
+        fingerprints.delete()
+
+
 @receiver(post_delete, sender=IndexProfile)
 def remove_index_from_search_model(sender, instance, **kwargs):
     # TODO
@@ -56,3 +68,20 @@ def remove_index_from_search_model(sender, instance, **kwargs):
 def delete_related_alias(sender, instance, **kwargs):
     if instance.alias:
         instance.alias.delete()
+
+
+@receiver(post_save, sender=Alias)
+@receiver(post_delete, sender=Alias)
+@receiver(post_save, sender=SearchModel)
+@receiver(post_delete, sender=SearchModel)
+@receiver(post_save, sender=IndexProfile)
+@receiver(post_delete, sender=IndexProfile)
+@receiver(m2m_changed, sender=SearchModel.indexes.through)
+def invalidate_search_cache(sender, **kwargs):
+    bump_version('search')
+
+
+@receiver(index_changed)
+def invalidate_search_results(sender, **kwargs):
+    # Plugins keep the field aliases of the indices
+    bump_version('search')
@@ -0,0 +1,80 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.test import SimpleTestCase
+from json import dumps
+from json import loads
+from onegeo_api.extensions import QueryTemplate
+import re
+
+
+COLUMNS_BY_TYPE = {'keyword': ('k', ), 'text': ('a', 'b')}
+
+
+def get_fields(type, prefix='properties'):
+    return list(
+        '{}.{}'.format(prefix, name) for name in COLUMNS_BY_TYPE.get(type, ()))
+
+
+def render_as_text(query_dsl, **params):
+    """Render the template as `Plugin.input` formerly did, on its JSON."""
+    query_dsl = re.sub(
+        '{%(.+?)%}',
+        lambda m: re.sub(
+            '(\w+)(\|(.+))?',
+            lambda m: params.get(m.group(1), m.group(3)),
+            m.group(1)),
+        dumps(query_dsl))
+    query_dsl = re.sub(
+        '{\*(.+?)\*}',
+        lambda m: re.sub(
+            '(\w+)\.\<(\w+)\>',
+            lambda m: '", "'.join(get_fields(m.group(2), prefix=m.group(1))),
+            m.group(1)),
+        query_dsl)
+    return loads(query_dsl)
+
+
+class QueryTemplateTestCase(SimpleTestCase):
+
+    TEMPLATES = (
+        {'query': {'match': {'properties.a': '{%q%}'}},
+         'size': '{%size|10%}'},
+        {'query': {'multi_match': {
+            'query': '{%q|*%}', 'fields': ['{*properties.<text>*}', 'k']}},
+         'sort': [{'{%sort|properties.k%}': '{%order|asc%}'}]},
+        {'aggs': {
+            'by_{%agg|k%}': {'terms': {'field': 'properties.{%agg|k%}'}}},
+         'query': {'term': {'{*properties.<keyword>*}': '{%q%}'}}})
+
+    PARAMS = (
+        {'q': 'foo'},
+        {'q': 'foo', 'size': '5', 'sort': 'properties.a', 'order': 'desc'},
+        {'q': 'foo', 'agg': 'a'})
+
+    def test_render_as_text(self):
+        for query_dsl in self.TEMPLATES:
+            template = QueryTemplate(query_dsl, get_fields)
+            for params in self.PARAMS:
+                self.assertEqual(
+                    template.render(**params),
+                    render_as_text(query_dsl, **params))
+
+    def test_params(self):
+        template = QueryTemplate(self.TEMPLATES[1], get_fields)
+        self.assertEqual(
+            sorted(template.params),
+            [('order', 'asc'), ('q', '*'), ('sort', 'properties.k')])
@@ -0,0 +1,81 @@
+# Copyright (c) 2017-2019 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.conf import settings
+from elasticsearch import Urllib3HttpConnection
+import gzip
+
+
+# Request bodies bigger than `HTTP_COMPRESS_MIN_BYTES` are gzip-compressed
+# (mostly bulk requests), and responses are requested compressed.
+HTTP_COMPRESS = getattr(settings, 'ELASTICSEARCH_HTTP_COMPRESS', False)
+HTTP_COMPRESS_MIN_BYTES = getattr(
+    settings, 'ELASTICSEARCH_HTTP_COMPRESS_MIN_BYTES', 65536)
+HTTP_COMPRESS_LEVEL = getattr(settings, 'ELASTICSEARCH_HTTP_COMPRESS_LEVEL', 1)
+
+# Connection pool: number of connections kept per node (at least the number
+# of concurrent bulk requests), request timeout and retries (in seconds).
+MAXSIZE = getattr(settings, 'ELASTICSEARCH_MAXSIZE', 10)
+TIMEOUT = getattr(settings, 'ELASTICSEARCH_TIMEOUT', 30)
+MAX_RETRIES = getattr(settings, 'ELASTICSEARCH_MAX_RETRIES', 3)
+RETRY_ON_TIMEOUT = getattr(settings, 'ELASTICSEARCH_RETRY_ON_TIMEOUT', False)
+# Discovery of the nodes of the cluster, on start, on connection failure
+# and then every `SNIFFER_TIMEOUT` seconds.
+SNIFF = getattr(settings, 'ELASTICSEARCH_SNIFF', False)
+SNIFFER_TIMEOUT = getattr(settings, 'ELASTICSEARCH_SNIFFER_TIMEOUT', 60)
+
+
+def compress(body, level=HTTP_COMPRESS_LEVEL):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return gzip.compress(body, compresslevel=level)
+
+
+class CompressedHttpConnection(Urllib3HttpConnection):
+    """Connection gzip-compressing the large request bodies."""
+
+    def __init__(self, *args, min_bytes=HTTP_COMPRESS_MIN_BYTES,
+                 level=HTTP_COMPRESS_LEVEL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_bytes = min_bytes
+        self.level = level
+        self.headers['accept-encoding'] = 'gzip'
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=(), headers=None):
+        if body is not None and len(body) >= self.min_bytes:
+            body = compress(body, level=self.level)
+            headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+        return super().perform_request(
+            method, url, params=params, body=body, timeout=timeout,
+            ignore=ignore, headers=headers)
+
+
+def get_connection_options(maxsize=MAXSIZE):
+    """Return the connection options of the Elasticsearch client."""
+    options = {
+        'maxsize': maxsize,
+        'timeout': TIMEOUT,
+        'max_retries': MAX_RETRIES,
+        'retry_on_timeout': RETRY_ON_TIMEOUT}
+    if SNIFF:
+        options.update({
+            'sniff_on_start': True,
+            'sniff_on_connection_fail': True,
+            'sniffer_timeout': SNIFFER_TIMEOUT})
+    if HTTP_COMPRESS:
+        options['connection_class'] = CompressedHttpConnection
+    return options
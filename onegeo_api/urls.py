@@ -25,6 +25,7 @@ from onegeo_api.views.index_profile import IndexProfilesList
 from onegeo_api.views import Protocols
 from onegeo_api.views.resource import ResourcesDetail
 from onegeo_api.views.resource import ResourcesList
+from onegeo_api.views.search_model import MultiSearch
 from onegeo_api.views.search_model import Search
 from onegeo_api.views.search_model import SearchModelsDetail
 from onegeo_api.views.search_model import SearchModelsList
@@ -58,6 +59,7 @@ urlpatterns = (
 
     url('^queue/(?P<uuid>(\w|-){1,100})/?$', AsyncTask.as_view(), name='queue'),
 
+    url('^services/_msearch/?$', MultiSearch.as_view(), name='msearch'),
     url('^services/(?P<name>(\w|-){1,100})/search/?$', Search.as_view(), name='search'),
     url('^services/(?P<name>(\w|-){1,100})/?$', SearchModelsDetail.as_view(), name='search_model'),
     url('^services/?$', SearchModelsList.as_view(), name='search_models'),
@@ -148,7 +148,10 @@ class IndexProfilesDetail(View):
                 ', '.join("'{}'".format(str(item)) for item in fields.difference(expected)))
             return JsonResponse({'error': msg}, status=400)
 
-        data = dict((k, v) for k, v in data.items() if k in fields)
+        optional_fields = set(IndexProfile.Extras.optional_fields)
+        data = dict(
+            (k, v) for k, v in data.items()
+            if k in fields or k in optional_fields)
 
         if data['resource'] != index_profile.resource.location:
             msg = 'The resource could not be changed'
@@ -15,6 +15,7 @@
 
 
 from base64 import b64decode
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.http import HttpResponse
@@ -22,8 +23,12 @@ from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
+from hashlib import md5
 from importlib import import_module
 import json
+from onegeo_api.cache import get_plugin
+from onegeo_api.cache import result_cache
+from onegeo_api.cache import routing_table
 from onegeo_api.elastic import elastic_conn
 from onegeo_api.exceptions import ElasticError
 from onegeo_api.models import IndexProfile
@@ -33,6 +38,10 @@ import re
 from requests.exceptions import HTTPError
 
 
+# Maximum number of searches of a multi-search request.
+MULTI_SEARCH_MAX_SIZE = getattr(settings, 'ONEGEO_MULTI_SEARCH_MAX_SIZE', 100)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class SearchModelsList(View):
 
@@ -158,33 +167,46 @@ class SearchModelsDetail(View):
         return HttpResponse(status=204)
 
 
+def get_credentials(request):
+    user = None
+    password = None
+    if 'HTTP_AUTHORIZATION' in request.META:
+        auth = request.META['HTTP_AUTHORIZATION'].split()
+        if len(auth) == 2 and auth[0].lower() == 'basic':
+            user, password = b64decode(auth[1]).decode('utf-8').split(':')
+    return user, password
+
+
+def get_search_plugin(name, route, user, password):
+    try:
+        ext = import_module('...extensions.{}'.format(name), __name__)
+    except ImportError:
+        ext = import_module('...extensions.__init__', __name__)
+
+    def create_plugin():
+        return ext.plugin(route.query_dsl, route.index_profiles,
+                          user=user, password=password)
+
+    # Only stateless plugins are shared by the searches
+    if not getattr(ext.plugin, 'cacheable', False):
+        return create_plugin()
+
+    # Plugins may depend on the credentials of the user
+    key = (name, user, password and md5(password.encode()).hexdigest())
+    return get_plugin(key, create_plugin)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class Search(View):
 
     def get(self, request, name):
 
-        user = None
-        password = None
-        if 'HTTP_AUTHORIZATION' in request.META:
-            auth = request.META['HTTP_AUTHORIZATION'].split()
-            if len(auth) == 2 and auth[0].lower() == 'basic':
-                user, password = b64decode(auth[1]).decode('utf-8').split(':')
-
-        if name == '_all':
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(
-                    searchmodel__in=SearchModel.objects.all())]
-        else:
-            try:
-                instance = SearchModel.get_or_raise(name)
-            except SearchModel.DoesNotExist:
-                return HttpResponse(status=404)
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(searchmodel=instance)]
+        user, password = get_credentials(request)
 
-        index = [m.uuid for m in index_profiles]
+        route = routing_table.get(name)
+        if route is None:
+            return HttpResponse(status=404)
+        index = route.indices
 
         params = dict((k, ','.join(v)) for k, v in dict(request.GET).items())
         if '_through' in params and not re.match(
@@ -200,20 +222,30 @@ class Search(View):
 
         # else:
         try:
-            ext = import_module('...extensions.{}'.format(name), __name__)
-        except ImportError:
-            ext = import_module('...extensions.__init__', __name__)
-        # else:
-        try:
-            plugin = ext.plugin(instance.query_dsl, index_profiles,
-                                user=user, password=password)
+            plugin = get_search_plugin(name, route, user, password)
         except HTTPError as err:
             return JsonResponse(
                 data={'error': str(err)}, status=err.response.status_code)
 
         try:
-            return plugin.output(
-                elastic_conn.search(index=index, body=plugin.input(**params)))
+            body = plugin.input(**params)
+            search_params = plugin.get_search_params(body)
+            key = None
+            if result_cache.enabled:
+                key = result_cache.get_key(
+                    name, params, body, index, search_params=search_params,
+                    user=user, password=password and md5(
+                        password.encode()).hexdigest())
+                result = result_cache.get(key)
+                if result is not None:
+                    content_type, content = result
+                    return HttpResponse(content, content_type=content_type)
+            response = plugin.output(elastic_conn.search(
+                index=index, body=body, params=search_params))
+            if key and response.status_code == 200:
+                result_cache.set(
+                    key, response['Content-Type'], response.content)
+            return response
         except ElasticError as e:
             return JsonResponse(
                 data={'error': e.__str__(), 'details': e.details},
@@ -228,28 +260,12 @@ class Search(View):
                 data={'error': 'Malformed JSON', 'details': e.__str__()},
                 status=400)
 
-        user = None
-        password = None
-        if 'HTTP_AUTHORIZATION' in request.META:
-            auth = request.META['HTTP_AUTHORIZATION'].split()
-            if len(auth) == 2 and auth[0].lower() == 'basic':
-                user, password = b64decode(auth[1]).decode('utf-8').split(':')
-
-        if name == '_all':
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(
-                    searchmodel__in=SearchModel.objects.all())]
-        else:
-            try:
-                instance = SearchModel.get_or_raise(name)
-            except SearchModel.DoesNotExist:
-                return HttpResponse(status=404)
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(searchmodel=instance)]
+        user, password = get_credentials(request)
 
-        index = [m.uuid for m in index_profiles]
+        route = routing_table.get(name)
+        if route is None:
+            return HttpResponse(status=404)
+        index = route.indices
 
         params = dict((k, ','.join(v)) for k, v in dict(request.GET).items())
 
@@ -266,3 +282,75 @@ class Search(View):
                     status=e.status_code)
         # else:
         return HttpResponse(status=400)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class MultiSearch(View):
+
+    def post(self, request):
+
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except json.decoder.JSONDecodeError as e:
+            return JsonResponse(
+                data={'error': 'Malformed JSON', 'details': e.__str__()},
+                status=400)
+
+        if not isinstance(data, list) or not all(
+                isinstance(item, dict) and 'service' in item for item in data):
+            msg = "A list of objects with a 'service' is expected."
+            return JsonResponse(data={'error': msg}, status=400)
+
+        if len(data) > MULTI_SEARCH_MAX_SIZE:
+            msg = 'At most {} searches are expected.'.format(
+                MULTI_SEARCH_MAX_SIZE)
+            return JsonResponse(data={'error': msg}, status=400)
+
+        user, password = get_credentials(request)
+
+        results = [None] * len(data)
+        searches = []
+        for i, item in enumerate(data):
+            name = item['service']
+            params = dict(
+                (k, ','.join(map(str, v)) if isinstance(v, list) else str(v))
+                for k, v in (item.get('params') or {}).items())
+            route = routing_table.get(name)
+            if route is None:
+                results[i] = {'error': 'Not found.', 'status': 404}
+                continue
+            try:
+                plugin = get_search_plugin(name, route, user, password)
+            except HTTPError as err:
+                results[i] = {
+                    'error': str(err), 'status': err.response.status_code}
+                continue
+            try:
+                body = plugin.input(**params)
+                search_params = plugin.get_search_params(body)
+            except ElasticError as e:
+                results[i] = {
+                    'error': e.__str__(), 'details': e.details,
+                    'status': e.status_code}
+                continue
+            searches.append((
+                i, plugin, params, route.indices, body, search_params))
+
+        try:
+            responses = elastic_conn.msearch(
+                (indices, body, search_params)
+                for _, _, _, indices, body, search_params in searches)
+        except ElasticError as e:
+            return JsonResponse(
+                data={'error': e.__str__(), 'details': e.details},
+                status=e.status_code)
+
+        for (i, plugin, params, _, _, _), res in zip(searches, responses):
+            if 'error' in res:
+                results[i] = {
+                    'error': 'Elasticsearch returns an error.',
+                    'details': res['error'], 'status': res.get('status')}
+            else:
+                results[i] = plugin.format(res, **params)
+
+        return JsonResponse(data=results, safe=False)
@@ -81,9 +81,12 @@ class AsyncTask(View):
                 redirect_to=reduce(
                     urljoin, ['/', API_BASE_PATH, instance.target.location[1:]]))
         # else: instance.success is None
-        return JsonResponse(data={
+        data = {
             # TODO task should be cancelable
             'status': 'pending',
             'start': instance.start_date,
             'elapsed_time': float('{0:.2f}'.format(
-                instance.elapsed_time.total_seconds()))})
+                instance.elapsed_time.total_seconds()))}
+        if instance.details and 'progress' in instance.details:
+            data['progress'] = instance.details['progress']
+        return JsonResponse(data=data)